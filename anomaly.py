@@ -0,0 +1,325 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+import saturation
+
+# ===== 異常偵測設定 =====
+# 感測器異常會讓所有平均值失真，所以在計算圖表之前先找出來、排除掉
+# 偵測三種異常：
+# - 超過容量：剩餘車位 > 總車位
+# - 數值凍結：同一個數值持續好幾個小時沒變（滿位和幾乎全空除外，尖峰一直滿位或半夜沒車是正常的），
+#   歷史資料從數值最後一次改變時就算凍結
+# - 突然跳動：5 分鐘內變化遠大於平常的變化幅度，之後一直到數值回到跳動前附近為止都算異常
+#
+# 每個停車場只保存固定幾個狀態值（上一筆數值、最後變動時間、平均變化幅度、跳動前的數值...），
+# 新資料一批一批進來，所有停車場一起用向量運算處理（只有真的發生跳動的停車場才逐段往後找）
+FROZEN_DURATION = pd.Timedelta(hours=3)
+NEAR_EMPTY_RATIO = 0.9               # 剩餘車位 ≥ 總車位 90% 視為幾乎全空，長時間不變不算凍結
+MAX_GAP = pd.Timedelta(minutes=15)   # 間隔超過 15 分鐘，跳動不算異常（中間可能真的發生了變化）
+JUMP_MIN_RATIO = 0.2                 # 一次變化至少超過總車位 20% 才可能算跳動
+JUMP_Z = 8                           # 或是超過平常變化幅度的 8 倍
+JUMP_MAX_DURATION = pd.Timedelta(hours=1)  # 跳動後 1 小時還沒回到原本的數值，視為真的變了，不再排除
+EWMA_ALPHA = 0.05                    # 平常變化幅度的更新速度
+MIN_DELTAS = 12                      # 累積 12 筆變化（約 1 小時）後才使用平常變化幅度
+
+ANOMALY_TYPES = {
+    'over_capacity': '超過容量',
+    'jump': '突然跳動',
+    'frozen': '數值凍結',
+}
+
+STATE_COLUMNS = ['last_time', 'last_value', 'last_change_time', 'last_frozen', 'jump_anchor', 'jump_since', 'ewma_abs_delta', 'n_deltas']
+
+
+class AnomalyDetector:
+    def __init__(self, state=None):
+        if state is None:
+            state = pd.DataFrame(columns=STATE_COLUMNS)
+            state.index.name = 'parking_lot_id'
+        self.state = state
+
+    # ===== 處理一批新快照 =====
+    # batch 欄位：parking_lot_id、taipei_time、available_cars、total_cars（可以同時包含很多停車場）
+    # 回傳依停車場、時間排序的 batch，加上 over_capacity、frozen、jump、is_anomaly、anomaly_type 欄位，
+    # 和 unchanged_since（數值最後一次改變的時間）
+    def process(self, batch):
+        frame = batch.assign(taipei_time=pd.to_datetime(batch['taipei_time']))
+        frame = frame.sort_values(['parking_lot_id', 'taipei_time'], kind='stable')
+        if frame.empty:
+            return frame.assign(over_capacity=False, frozen=False, jump=False, is_anomaly=False, anomaly_type=None, unchanged_since=pd.NaT)
+
+        lot = frame['parking_lot_id'].to_numpy()
+        time = frame['taipei_time'].to_numpy()
+        value = frame['available_cars'].to_numpy(dtype=float)
+        total = frame['total_cars'].to_numpy(dtype=float)
+        first = np.concatenate([[True], lot[1:] != lot[:-1]])
+
+        # 每一列對應到所屬停車場目前的狀態（沒看過的停車場是空值）
+        state = self.state.reindex(lot)
+        prev_value = np.concatenate([[np.nan], value[:-1]])
+        prev_value[first] = state['last_value'].to_numpy(dtype=float)[first]
+        prev_time = pd.Series(np.concatenate([time[:1], time[:-1]]))
+        prev_time[first] = pd.to_datetime(state['last_time']).to_numpy()[first]
+
+        delta = value - prev_value
+        gap = (pd.Series(time) - prev_time).to_numpy()
+        continuous = gap <= MAX_GAP.to_timedelta64()
+
+        # --- 超過容量 ---
+        over_capacity = value > total
+
+        # --- 數值凍結：往前找最後一次數值改變的時間 ---
+        changed = ~(value == prev_value)
+        change_time = pd.Series(np.where(changed, time, np.datetime64('NaT')))
+        carried = first & ~changed
+        change_time[carried] = pd.to_datetime(state['last_change_time']).to_numpy()[carried]
+        change_time = change_time.groupby(np.cumsum(first)).ffill()
+        frozen = ((pd.Series(time) - change_time) >= FROZEN_DURATION).to_numpy() & _can_freeze(value, total)
+
+        # --- 突然跳動：變化超過門檻 ---
+        # 凍結結束後的第一筆是恢復正常，不算跳動
+        warm = state['n_deltas'].fillna(0).to_numpy(dtype=float) >= MIN_DELTAS
+        usual = np.where(warm, state['ewma_abs_delta'].to_numpy(dtype=float), 0.0)
+        threshold = np.maximum(JUMP_MIN_RATIO * total, JUMP_Z * usual)
+        big = (np.abs(delta) > threshold) & continuous
+        prev_frozen = np.concatenate([[False], frozen[:-1]])
+        prev_frozen[first] = state['last_frozen'].fillna(False).to_numpy(dtype=bool)[first]
+        jump, jump_anchor, jump_since = self._find_jumps(
+            lot, time, value, prev_value, threshold, continuous, big & ~prev_frozen, first, state
+        )
+
+        is_anomaly = over_capacity | frozen | jump
+        anomaly_type = np.select([over_capacity, jump, frozen], list(ANOMALY_TYPES), default=None)
+
+        self._update_state(lot, time, value, change_time, frozen, jump_anchor, jump_since, delta, continuous & ~big & ~is_anomaly)
+
+        return frame.assign(
+            over_capacity=over_capacity,
+            frozen=frozen,
+            jump=jump,
+            is_anomaly=is_anomaly,
+            anomaly_type=anomaly_type,
+            unchanged_since=change_time.to_numpy(),
+        )
+
+    # ===== 找出跳動期間 =====
+    # 跳動開始時記下跳動前的數值（anchor），之後每一筆都算跳動，直到：
+    # - 數值回到 anchor 附近（這一步是恢復正常，不算跳動）
+    # - 資料中斷，或超過 JUMP_MAX_DURATION（視為真的變了）
+    # 上一批結束時還在跳動中的停車場，從 state 的 jump_anchor、jump_since 接著判斷
+    # 回傳（是否為跳動, 每一列之後的 anchor, 每一列之後的跳動開始時間），沒有在跳動中時 anchor 是空值
+    def _find_jumps(self, lot, time, value, prev_value, threshold, continuous, starts, first, state):
+        n = len(value)
+        jump = np.zeros(n, dtype=bool)
+        anchor_after = np.full(n, np.nan)
+        since_after = np.full(n, np.datetime64('NaT'), dtype=time.dtype)
+
+        carried_anchor = state['jump_anchor'].to_numpy(dtype=float)
+        carried_since = pd.to_datetime(state['jump_since']).to_numpy()
+        bounds = np.append(np.flatnonzero(first), n)
+        active = np.flatnonzero(first & ~np.isnan(carried_anchor))
+        candidates = np.union1d(active, np.flatnonzero(starts))
+        lot_begins = bounds[np.searchsorted(bounds, candidates, side='right') - 1]
+
+        # 只有發生跳動（或上一批還在跳動中）的停車場需要往後找
+        for begin in np.unique(lot_begins):
+            end = bounds[np.searchsorted(bounds, begin, side='right')]
+            starts_here = np.flatnonzero(starts[begin:end]) + begin
+            anchor, since, pos = carried_anchor[begin], carried_since[begin], begin
+
+            while pos < end:
+                if np.isnan(anchor):
+                    later = starts_here[starts_here >= pos]
+                    if len(later) == 0:
+                        break
+                    pos = later[0]
+                    anchor, since = prev_value[pos], time[pos]
+                    jump[pos] = True
+                    anchor_after[pos], since_after[pos] = anchor, since
+                    pos += 1
+                    continue
+
+                seg = slice(pos, end)
+                back = np.abs(value[seg] - anchor) <= threshold[seg]
+                expired = (time[seg] - since) > JUMP_MAX_DURATION.to_timedelta64()
+                ended = back | expired | ~continuous[seg]
+                if not ended.any():
+                    jump[seg] = True
+                    anchor_after[seg], since_after[seg] = anchor, since
+                    break
+                k = int(np.argmax(ended))
+                jump[pos:pos + k] = True
+                anchor_after[pos:pos + k], since_after[pos:pos + k] = anchor, since
+                # 回到原本數值的那一筆不會再當成新的跳動；過期或中斷的那一筆照一般規則判斷
+                anchor, since = np.nan, None
+                pos = pos + k + (1 if back[k] else 0)
+
+        return jump, anchor_after, since_after
+
+    # ===== 更新每個停車場的狀態 =====
+    # 平常變化幅度只用正常的變化來更新，異常值不會把門檻越拉越高
+    def _update_state(self, lot, time, value, change_time, frozen, jump_anchor, jump_since, delta, normal):
+        rows = pd.DataFrame({
+            'parking_lot_id': lot,
+            'last_time': time,
+            'last_value': value,
+            'last_change_time': change_time.to_numpy(),
+            'last_frozen': frozen,
+            'jump_anchor': jump_anchor,
+            'jump_since': jump_since,
+            'abs_delta': np.where(normal, np.abs(delta), np.nan),
+        })
+        # 每個停車場的最後一列（不能用 groupby.last()，它會跳過空值，結束的跳動會被誤接回來）
+        latest = rows.drop_duplicates('parking_lot_id', keep='last').set_index('parking_lot_id')
+        latest = latest[['last_time', 'last_value', 'last_change_time', 'last_frozen', 'jump_anchor', 'jump_since']]
+        grouped = rows.groupby('parking_lot_id', sort=False)
+        k = grouped['abs_delta'].count().reindex(latest.index)
+        batch_mean = grouped['abs_delta'].mean().reindex(latest.index)
+
+        old = self.state.reindex(latest.index)
+        old_ewma = old['ewma_abs_delta'].astype(float)
+        decay = (1 - EWMA_ALPHA) ** k
+        latest['ewma_abs_delta'] = np.where(
+            old_ewma.isna(), batch_mean, np.where(k > 0, decay * old_ewma + (1 - decay) * batch_mean, old_ewma)
+        )
+        latest['n_deltas'] = old['n_deltas'].fillna(0).astype(float) + k
+
+        unchanged = self.state[~self.state.index.isin(latest.index)]
+        new_state = latest[STATE_COLUMNS] if unchanged.empty else pd.concat([unchanged, latest[STATE_COLUMNS]])
+        new_state.index.name = 'parking_lot_id'
+        self.state = new_state
+
+
+# 滿位（和 saturation 相同的門檻）或幾乎全空時不變是正常的
+def _can_freeze(value, total):
+    full = value <= np.floor(total * saturation.FULL_RATIO)
+    near_empty = value >= total * NEAR_EMPTY_RATIO
+    return ~full & ~near_empty
+
+
+# ===== 分批送進偵測器 =====
+# 同一批裡的門檻是固定的，切成小批次，前一批累積的平常變化幅度就能用在下一批
+def process_in_chunks(detector, df, freq):
+    if df.empty:
+        return detector.process(df)
+    chunks = pd.to_datetime(df['taipei_time']).dt.floor(freq)
+    return pd.concat([detector.process(batch) for _, batch in df.groupby(chunks, sort=True)])
+
+
+# 一段歷史資料：每天一批
+# detector（可省略）：接著前一段資料的偵測器繼續處理，處理完的狀態留在 detector.state
+# pending（可省略）：前一段用 split_pending 保留下來、還沒確定是否凍結的資料，接在這段前面一起判斷
+def detect_history(df, detector=None, pending=None):
+    if 'parking_lot_id' not in df.columns:
+        df = df.assign(parking_lot_id='')
+    flagged = process_in_chunks(detector or AnomalyDetector(), df, 'D')
+    if pending is not None and not pending.empty:
+        flagged = pd.concat([pending, flagged]).sort_values(['parking_lot_id', 'taipei_time'], kind='stable')
+    return _backfill_frozen(flagged)
+
+
+# 凍結要持續 3 小時才確定，確定之後往回把同一段沒變的快照都算成凍結（事件從數值最後一次改變時開始）
+# 已經是其他異常（例如跳動後停住）的快照維持原本的類型
+def _backfill_frozen(flagged):
+    stuck = flagged.groupby(['parking_lot_id', 'unchanged_since'], sort=False, dropna=False)['frozen'].transform('any')
+    stuck = stuck.astype(bool) & ~flagged['frozen']
+    if not stuck.any():
+        return flagged
+    flagged = flagged.copy()
+    flagged['anomaly_type'] = flagged['anomaly_type'].where(flagged['is_anomaly'] | ~stuck, 'frozen')
+    flagged['frozen'] |= stuck
+    flagged['is_anomaly'] |= stuck
+    return flagged
+
+
+# ===== 還沒確定的凍結 =====
+# 每個停車場最後一段沒變的數值，之後的資料可能讓它變成凍結（往回標記），所以分段計算時先不算進這一段
+# 回傳（已經確定的資料, 保留給下一段的資料）；保留的資料傳給下一段的 detect_history(pending=...)
+# align（可省略）：例如 'h'，從這段數值開始的那個時間區間起全部保留，下一段才能算出完整的區間
+def split_pending(flagged, align=None):
+    if flagged.empty:
+        return flagged, flagged.iloc[:0]
+    lot = flagged['parking_lot_id']
+    last = flagged.groupby(lot, sort=False)[['unchanged_since', 'frozen']].transform('last')
+    can_freeze = _can_freeze(flagged['available_cars'].to_numpy(dtype=float), flagged['total_cars'].to_numpy(dtype=float))
+    undecided = (flagged['unchanged_since'] == last['unchanged_since']) & ~last['frozen'].astype(bool) & can_freeze
+    since = flagged['taipei_time'].where(undecided).groupby(lot, sort=False).transform('min')
+    if align is not None:
+        since = since.dt.floor(align)
+    keep = flagged['taipei_time'] >= since
+    return flagged[~keep], flagged[keep]
+
+
+# ===== 排除異常資料 =====
+# 回傳（排除異常後的資料, 加上異常標記的完整資料）
+def mask_anomalies(df, detector=None):
+    flagged = detect_history(df, detector)
+    return df.drop(index=flagged.index[flagged['is_anomaly']]), flagged
+
+
+# ===== 把連續的異常整理成事件 =====
+# 同一個停車場、同一種異常、資料沒有中斷的連續幾筆算一個事件
+def group_incidents(flagged):
+    anomalies = flagged[flagged['is_anomaly']].sort_values(['parking_lot_id', 'taipei_time'], kind='stable')
+    if anomalies.empty:
+        return pd.DataFrame(columns=['parking_lot_id', 'anomaly_type', 'start', 'end', 'readings', 'min_value', 'max_value'])
+
+    lot = anomalies['parking_lot_id']
+    kind = anomalies['anomaly_type']
+    time = anomalies['taipei_time']
+    new_incident = lot.ne(lot.shift()) | kind.ne(kind.shift()) | (time.diff() > MAX_GAP)
+    incident_id = new_incident.cumsum()
+
+    incidents = anomalies.groupby(incident_id).agg(
+        parking_lot_id=('parking_lot_id', 'first'),
+        anomaly_type=('anomaly_type', 'first'),
+        start=('taipei_time', 'min'),
+        end=('taipei_time', 'max'),
+        readings=('taipei_time', 'size'),
+        min_value=('available_cars', 'min'),
+        max_value=('available_cars', 'max'),
+    ).reset_index(drop=True)
+    return incidents.sort_values('start', ascending=False, ignore_index=True)
+
+
+# ===== 全市即時監控 =====
+# 整個 app 共用一個監控器：每次有新快照寫入，就只抓上次之後的新資料送進偵測器
+# 只保留最近 24 小時的異常資料，記憶體用量固定
+class AnomalyMonitor:
+    def __init__(self, retention=pd.Timedelta(hours=24)):
+        self.detector = AnomalyDetector()
+        self.retention = retention
+        self.watermark = None       # 已經處理到的 record_time（UTC）
+        self.data_version = None
+        self._anomalies = None      # 第一次載入完成前是 None
+        self._lock = threading.Lock()
+
+    # fetch_since(watermark) 回傳 watermark 之後的新快照，欄位要有 record_time
+    # 同時有多人觸發時，只讓一個人去抓資料，其他人直接用目前的結果（第一次載入還沒完成時 incidents() 是 None）
+    # 第一次會讀進 24 小時的資料，每小時一批處理；之後每次通常只有一批新快照
+    def poll(self, fetch_since, data_version):
+        if data_version == self.data_version or not self._lock.acquire(blocking=False):
+            return
+        try:
+            batch = fetch_since(self.watermark)
+            if not batch.empty:
+                flagged = process_in_chunks(self.detector, batch, 'h')
+                new_anomalies = flagged[flagged['is_anomaly']]
+                anomalies = new_anomalies if self._anomalies is None or self._anomalies.empty else pd.concat([self._anomalies, new_anomalies])
+                cutoff = flagged['taipei_time'].max() - self.retention
+                self._anomalies = anomalies[anomalies['taipei_time'] >= cutoff]
+                self.watermark = batch['record_time'].max()
+            elif self._anomalies is None:
+                self._anomalies = batch.iloc[:0].assign(is_anomaly=False, anomaly_type=None)
+            self.data_version = data_version
+        finally:
+            self._lock.release()
+
+    # 最近 24 小時的異常事件；第一次載入還沒完成時回傳 None（不是「沒有異常」）
+    def incidents(self):
+        anomalies = self._anomalies
+        if anomalies is None:
+            return None
+        return group_incidents(anomalies)
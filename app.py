@@ -1,11 +1,15 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-from google.cloud import bigquery
-from google.oauth2 import service_account
 from datetime import datetime, timedelta
 
+import anomaly
+import charts
+import forecast
+import parking_data
+import prewarm
+import report_export
+import saturation
+
 # ===== 頁面設定 =====
 st.set_page_config(
     page_title="台北停車場分析儀表板",
@@ -272,51 +276,183 @@ st.markdown("""
 # ===== 連接 BigQuery =====
 @st.cache_resource
 def get_bigquery_client():
-    credentials = service_account.Credentials.from_service_account_info(
-        st.secrets["gcp_service_account"]
-    )
-    return bigquery.Client(credentials=credentials)
+    return parking_data.create_client(st.secrets["gcp_service_account"])
 
 client = get_bigquery_client()
 
+# ===== 資料新鮮度 =====
+# 快取不再用固定的 TTL，而是看 BigQuery 資料表「最後更新時間」決定要不要重新查詢：
+# - 結束日期早於最後寫入的那一天：資料不會再變，快取永遠有效
+# - 範圍包含今天：只有新的快照寫入後（最後更新時間改變）才重新查詢
+# 查最後更新時間是讀 metadata，不掃資料也不計費；這裡 30 秒內重複使用同一個結果
+@st.cache_data(ttl=30)
+def get_table_modified(table_id):
+    return parking_data.fetch_table_modified(client, table_id)
+
+CLOSED_RANGE = "closed"
+
+# 這一天之前的資料都已經寫完，不會再變
+def get_settled_day():
+    return parking_data.settled_day(get_table_modified(parking_data.REALTIME_SPOTS_TABLE))
+
+def get_data_version(end_date):
+    if end_date < get_settled_day():
+        return CLOSED_RANGE
+    return get_table_modified(parking_data.REALTIME_SPOTS_TABLE).isoformat()
+
+def get_lots_version():
+    return get_table_modified(parking_data.PARKING_LOTS_TABLE).isoformat()
+
 # ===== 取得停車場清單 =====
-@st.cache_data(ttl=3600)
-def get_parking_lots():
-    query = """
-    SELECT parking_lot_id, name, area, total_cars, total_motor
-    FROM `parking-history-taipei.taipei_parking.parking_lots`
-    WHERE total_cars > 0
-    ORDER BY name
-    """
-    return client.query(query).to_dataframe()
+# lots_version：停車場資料表的最後更新時間（只用來當快取的 key）
+@st.cache_data(max_entries=10)
+def get_parking_lots(lots_version):
+    return parking_data.fetch_parking_lots(client)
 
 # ===== 取得停車資料 =====
-@st.cache_data(ttl=300)
-def get_parking_data(parking_lot_id, start_date, end_date, total_cars):
-    query = f"""
-    SELECT 
-        DATETIME(record_time, 'Asia/Taipei') AS taipei_time,
-        available_cars,
-        {total_cars} AS total_cars,
-        {total_cars} - available_cars AS used_cars,
-        ROUND(({total_cars} - available_cars) / {total_cars} * 100, 1) AS usage_rate,
-        EXTRACT(HOUR FROM DATETIME(record_time, 'Asia/Taipei')) AS hour,
-        EXTRACT(DAYOFWEEK FROM DATETIME(record_time, 'Asia/Taipei')) AS day_of_week,
-        FORMAT_DATETIME('%Y-%m-%d', DATETIME(record_time, 'Asia/Taipei')) AS date_str
-    FROM `parking-history-taipei.taipei_parking.realtime_spots`
-    WHERE parking_lot_id = '{parking_lot_id}'
-        AND available_cars >= 0
-        AND DATE(record_time, 'Asia/Taipei') BETWEEN '{start_date}' AND '{end_date}'
-    ORDER BY record_time
-    """
-    return client.query(query).to_dataframe()
+# data_version：get_data_version 的結果（只用來當快取的 key）
+# 已經不會變的期間，先找排程（python prewarm.py）預先存好的檔案
+@st.cache_data(max_entries=500)
+def get_parking_data(parking_lot_id, start_date, end_date, total_cars, data_version):
+    if data_version == CLOSED_RANGE:
+        df = prewarm.load_history(parking_lot_id, start_date, end_date, total_cars)
+        if df is not None:
+            return df
+    return parking_data.fetch_parking_data(client, parking_lot_id, start_date, end_date, total_cars)
+
+# 已經不會變的歷史資料算出來的部分彙總結果（永遠有效，早上預熱的就是這段）
+@st.cache_data(max_entries=500)
+def get_history_partial(parking_lot_id, start_date, end_date, total_cars, gran):
+    df = get_parking_data(parking_lot_id, start_date, end_date, total_cars, CLOSED_RANGE)
+    return charts.compute_partial(df, gran, complete=False)
+
+# ===== 取得圖表彙總結果 =====
+# 彙總結果也快取起來，切換圖表或匯出報表時不用重算；沒有資料（或全部是異常資料）時回傳 None
+# 範圍包含今天時拆成兩段：歷史部分直接用快取，新快照進來時只查詢、計算最近還在寫入的這一小段
+@st.cache_data(max_entries=500)
+def get_lot_aggregates(parking_lot_id, start_date, end_date, total_cars, gran, data_version):
+    if data_version != CLOSED_RANGE:
+        settled_day = get_settled_day()
+        if start_date < settled_day:
+            history = get_history_partial(parking_lot_id, start_date, settled_day - timedelta(days=1), total_cars, gran)
+            recent_df = parking_data.fetch_parking_data(client, parking_lot_id, settled_day, end_date, total_cars)
+            recent = charts.compute_partial(recent_df, gran, history['state'], history['pending'])
+            return charts.finalize_aggregates(charts.merge_partials(history, recent, gran))
+    df = get_parking_data(parking_lot_id, start_date, end_date, total_cars, data_version)
+    return charts.compute_aggregates(df, gran)
+
+# ===== 匯出報表：多個停車場一次查詢 =====
+# 還沒有快取的停車場用一次查詢一起抓回來，不用一個停車場查一次；回傳 {停車場代碼: 彙總結果}
+@st.cache_data(max_entries=50)
+def get_batch_aggregates(parking_lot_ids, start_date, end_date, gran, data_version):
+    df = parking_data.fetch_parking_data_batch(client, list(parking_lot_ids), start_date, end_date)
+    return {
+        lot_id: charts.compute_aggregates(df[df['parking_lot_id'] == lot_id].reset_index(drop=True), gran)
+        for lot_id in parking_lot_ids
+    }
+
+# ===== 全市停車場滿位統計 =====
+# 所有停車場一次查詢、一次計算，不用一個一個停車場載入
+# 每個停車場一列：摘要統計 + 各持續時間區間的事件數
+@st.cache_data(max_entries=20)
+def get_city_saturation(start_date, end_date, data_version, lots_version):
+    lots = get_parking_lots(lots_version)
+    lot_ids = lots['parking_lot_id'].tolist()
+    df, _ = anomaly.mask_anomalies(parking_data.fetch_parking_data_batch(client, lot_ids, start_date, end_date))
+    episodes = saturation.find_episodes(df)
+    summary = saturation.summarize_episodes(episodes, lot_ids)
+    histogram = saturation.duration_histogram(episodes).reindex(lot_ids, fill_value=0)
+    histogram = histogram.rename_axis(index='parking_lot_id', columns=None).reset_index()
+    return lots[['parking_lot_id', 'name', 'area', 'total_cars']].merge(summary, on='parking_lot_id').merge(histogram, on='parking_lot_id')
+
+# ===== 全市即時異常監控 =====
+# 整個 app 共用一個監控器（每個停車場只保存固定幾個狀態值）
+@st.cache_resource
+def get_anomaly_monitor():
+    return anomaly.AnomalyMonitor()
+
+# 有新快照寫入時，只把新進來的資料送進偵測器
+# 其他人正在做第一次載入時回傳 None
+def poll_anomaly_monitor():
+    monitor = get_anomaly_monitor()
+    monitor.poll(
+        lambda since: parking_data.fetch_snapshots_since(client, since),
+        get_table_modified(parking_data.REALTIME_SPOTS_TABLE)
+    )
+    return monitor.incidents()
+
+# 異常事件表格（欄位改成中文）
+def format_incidents(incidents):
+    return incidents.assign(
+        anomaly_type=incidents['anomaly_type'].map(anomaly.ANOMALY_TYPES),
+        start=pd.to_datetime(incidents['start']).dt.strftime('%m/%d %H:%M'),
+        end=pd.to_datetime(incidents['end']).dt.strftime('%m/%d %H:%M'),
+    ).rename(columns={
+        'parking_lot_id': '停車場代碼',
+        'name': '停車場名稱',
+        'anomaly_type': '異常類型',
+        'start': '開始',
+        'end': '結束',
+        'readings': '異常筆數',
+        'min_value': '最小值',
+        'max_value': '最大值',
+    })
+
+# ===== 取得預測模型參數 =====
+# 畫面載入時只讀取參數；建立、更新模型都在背景執行緒（見下方 refresh_forecast_model）
+# model_version：forecast.params_version 的結果（只用來當快取的 key），模型還沒建立時回傳 None
+@st.cache_data(max_entries=5)
+def get_forecast_params(model_version):
+    if model_version is None:
+        return None
+    return forecast.load_params()
+
+# 第一次建立（讀 90 天資料）或把前一天的資料增量加進模型
+def refresh_forecast_model():
+    if forecast.refresh_model(client):
+        print(f"預測模型已更新到 {forecast.params_version()}")
+
+# ===== 快取預熱 =====
+# 記錄大家常看的「停車場 × 期間 × 粒度」，每天早上 7:30 先把前幾名查好放進快取
+@st.cache_resource
+def get_request_log():
+    return prewarm.RequestLog()
+
+def estimate_prewarm_bytes(entry):
+    lot = get_parking_lots(get_lots_version()).set_index('parking_lot_id').loc[entry['parking_lot_id']]
+    start, end = prewarm.resolve_dates(entry, forecast.taipei_now().date())
+    return parking_data.estimate_parking_data_bytes(client, entry['parking_lot_id'], start, end, int(lot['total_cars']))
+
+# 範圍包含今天時，快取住的是歷史部分；早上使用者打開時只需要再查今天這一小段
+def warm_prewarm_entry(entry):
+    lot = get_parking_lots(get_lots_version()).set_index('parking_lot_id').loc[entry['parking_lot_id']]
+    start, end = prewarm.resolve_dates(entry, forecast.taipei_now().date())
+    get_lot_aggregates(entry['parking_lot_id'], start, end, int(lot['total_cars']), entry['gran'], get_data_version(end))
+
+def run_morning_prewarm():
+    entries = get_request_log().top(prewarm.PREWARM_TOP_K, forecast.taipei_now().date())
+    prewarm.print_result(prewarm.run_prewarm(entries, estimate_prewarm_bytes, warm_prewarm_entry))
+
+# 每天早上先更新預測模型，再預熱快取
+def run_morning_jobs():
+    refresh_forecast_model()
+    run_morning_prewarm()
+
+# 整個 app 只啟動一次排程（cache_resource 讓所有使用者共用同一個背景執行緒）
+# 啟動時先在背景建立 / 更新預測模型，Streamlit Cloud 上不需要另外排程 python forecast.py
+@st.cache_resource
+def start_prewarm_scheduler():
+    return prewarm.start_scheduler(run_morning_jobs, on_start=refresh_forecast_model)
+
+start_prewarm_scheduler()
 
 # ===== 側邊欄：篩選條件 =====
 with st.sidebar:
     st.markdown("### 🔍 篩選條件")
 
     # 停車場清單（靜態資料，放在 form 外面）
-    parking_lots = get_parking_lots()
+    lots_version = get_lots_version()
+    parking_lots = get_parking_lots(lots_version)
 
     default_index = 0
     if 'TPE0410' in parking_lots['parking_lot_id'].values:
@@ -339,7 +475,7 @@ with st.sidebar:
         st.markdown("##### ⏱️ 顯示設定")
         time_granularity = st.radio(
             "時間粒度",
-            ["5 分鐘", "15 分鐘", "30 分鐘", "1 小時", "4 小時"],
+            list(charts.GRANULARITY_MAP),
             index=0,
             horizontal=True
         )
@@ -351,6 +487,13 @@ with st.sidebar:
             horizontal=True
         )
 
+        forecast_horizon = st.radio(
+            "未來預測",
+            list(forecast.FORECAST_HORIZONS),
+            index=0,
+            horizontal=True
+        )
+
         # 提交按鈕
         st.form_submit_button("🔄 更新圖表", use_container_width=True)
 
@@ -360,10 +503,83 @@ with st.sidebar:
     total_cars = int(selected_lot['total_cars'])
     total_motor = int(selected_lot['total_motor'])
     area = selected_lot['area']
+    gran = charts.GRANULARITY_MAP[time_granularity]
+    data_version = get_data_version(end_date)
+
+    # ===== 側邊欄：批次匯出報表 =====
+    # 使用上方的資料期間，一次把多個停車場的卡片、熱力圖、週間 vs 週末曲線匯出成一份檔案
+    with st.expander("📦 匯出報表"):
+        with st.form(key="export_form"):
+            export_lot_names = st.multiselect(
+                "選擇停車場（可多選）",
+                parking_lots['name'].tolist(),
+                default=[selected_lot_name]
+            )
+            export_format = st.radio(
+                "檔案格式",
+                list(report_export.EXPORT_FORMATS),
+                format_func=lambda fmt: report_export.EXPORT_FORMATS[fmt],
+                horizontal=True
+            )
+            export_submitted = st.form_submit_button("📄 產生報表", use_container_width=True)
+
+        # 匯出條件改變後，之前產生的檔案就不再對應，先移除下載按鈕
+        export_key = (tuple(export_lot_names), export_format, start_date, end_date, gran)
+        if st.session_state.get('export_key') != export_key:
+            for state_key in ['export_file', 'export_name', 'export_mime']:
+                st.session_state.pop(state_key, None)
+
+        if export_submitted and export_lot_names:
+            export_lots = []
+            skipped_names = []
+            with st.spinner(f'產生 {len(export_lot_names)} 個停車場的報表中...'):
+                selected_export = parking_lots[parking_lots['name'].isin(export_lot_names)]
+                # 畫面上正在看的停車場已經有快取，其他停車場一次查詢
+                batch_ids = tuple(sorted(set(selected_export['parking_lot_id']) - {parking_lot_id}))
+                batch_aggregates = get_batch_aggregates(batch_ids, start_date, end_date, gran, data_version) if batch_ids else {}
+                for _, lot in selected_export.iterrows():
+                    if lot['parking_lot_id'] == parking_lot_id:
+                        lot_aggregates = get_lot_aggregates(parking_lot_id, start_date, end_date, total_cars, gran, data_version)
+                    else:
+                        lot_aggregates = batch_aggregates[lot['parking_lot_id']]
+                    if lot_aggregates is None:
+                        skipped_names.append(lot['name'])
+                        continue
+                    export_lots.append({
+                        'parking_lot_id': lot['parking_lot_id'],
+                        'name': lot['name'],
+                        'area': lot['area'],
+                        'total_cars': int(lot['total_cars']),
+                        'aggregates': lot_aggregates,
+                    })
+                if export_lots:
+                    st.session_state['export_file'] = report_export.export_report_pack(
+                        export_lots, export_format, f"資料期間：{start_date} - {end_date}"
+                    )
+                    st.session_state['export_name'] = f"停車場報表_{start_date}_{end_date}.{export_format}"
+                    st.session_state['export_mime'] = report_export.EXPORT_MIME_TYPES[export_format]
+                    st.session_state['export_key'] = export_key
+            if skipped_names:
+                st.warning(f"以下停車場在所選期間沒有資料，已略過：{'、'.join(skipped_names)}")
+
+        if 'export_file' in st.session_state:
+            st.download_button(
+                "⬇️ 下載報表",
+                data=st.session_state['export_file'],
+                file_name=st.session_state['export_name'],
+                mime=st.session_state['export_mime'],
+                use_container_width=True
+            )
 
 # ===== 讀取資料 =====
+# 篩選條件改變時記一筆查詢紀錄（切換熱力圖指標等重新整理不重複記錄）
+request_key = (parking_lot_id, start_date, end_date, gran)
+if st.session_state.get('last_request') != request_key:
+    st.session_state['last_request'] = request_key
+    get_request_log().record(parking_lot_id, start_date, end_date, gran, forecast.taipei_now().date())
+
 with st.spinner('載入資料中...'):
-    df = get_parking_data(parking_lot_id, start_date, end_date, total_cars)
+    aggregates = get_lot_aggregates(parking_lot_id, start_date, end_date, total_cars, gran, data_version)
 
 # ===== 標題區域 =====
 st.markdown(f"""
@@ -373,32 +589,12 @@ st.markdown(f"""
 </div>
 """, unsafe_allow_html=True)
 
-if df.empty:
+if aggregates is None:
     st.warning("所選日期範圍內沒有資料，請調整日期範圍。")
     st.stop()
 
 # ===== 數據計算 =====
-avg_available = df['available_cars'].mean()
-avg_usage = df['usage_rate'].mean()
-max_available = df['available_cars'].max()
-min_available = df['available_cars'].min()
-max_idx = df['available_cars'].idxmax()
-min_idx = df['available_cars'].idxmin()
-max_time = pd.to_datetime(df.loc[max_idx, 'taipei_time']).strftime('%m/%d %H:%M')
-min_time = pd.to_datetime(df.loc[min_idx, 'taipei_time']).strftime('%m/%d %H:%M')
-
-hourly_avg = df.groupby('hour')['usage_rate'].mean()
-peak_hours = hourly_avg[hourly_avg > 80].index.tolist() # 將尖峰定義提高到 80%
-if peak_hours:
-    peak_hours_str = f"{min(peak_hours)}:00-{max(peak_hours)+1}:00"
-else:
-    peak_hours_str = "無"
-
-df['is_weekend'] = df['day_of_week'].isin([1, 7])
-weekday_avg = df[~df['is_weekend']]['usage_rate'].mean()
-weekend_avg = df[df['is_weekend']]['usage_rate'].mean()
-if pd.isna(weekday_avg): weekday_avg = 0
-if pd.isna(weekend_avg): weekend_avg = 0
+summary = aggregates['summary']
 
 # ===== 指標卡片 =====
 col1, col2, col3, col4, col5 = st.columns(5)
@@ -407,8 +603,8 @@ with col1:
     st.markdown(f"""
     <div class="metric-card cyan">
         <div class="metric-label">平均剩餘車位</div>
-        <div class="metric-value cyan">{avg_available:.0f}</div>
-        <div class="metric-sub">平均使用率：{avg_usage:.1f}%</div>
+        <div class="metric-value cyan">{summary['avg_available']:.0f}</div>
+        <div class="metric-sub">平均使用率：{summary['avg_usage']:.1f}%</div>
     </div>
     """, unsafe_allow_html=True)
 
@@ -416,8 +612,8 @@ with col2:
     st.markdown(f"""
     <div class="metric-card emerald">
         <div class="metric-label">最高剩餘車位</div>
-        <div class="metric-value emerald">{max_available:.0f}</div>
-        <div class="metric-sub">{max_time}</div>
+        <div class="metric-value emerald">{summary['max_available']:.0f}</div>
+        <div class="metric-sub">{summary['max_time']}</div>
     </div>
     """, unsafe_allow_html=True)
 
@@ -425,8 +621,8 @@ with col3:
     st.markdown(f"""
     <div class="metric-card rose">
         <div class="metric-label">最低剩餘車位（滿位）</div>
-        <div class="metric-value rose">{min_available:.0f}</div>
-        <div class="metric-sub">{min_time}</div>
+        <div class="metric-value rose">{summary['min_available']:.0f}</div>
+        <div class="metric-sub">{summary['min_time']}</div>
     </div>
     """, unsafe_allow_html=True)
 
@@ -434,84 +630,43 @@ with col4:
     st.markdown(f"""
     <div class="metric-card amber">
         <div class="metric-label">尖峰時段</div>
-        <div class="metric-value amber">{peak_hours_str}</div>
+        <div class="metric-value amber">{summary['peak_hours_str']}</div>
         <div class="metric-sub">使用率 > 80%</div>
     </div>
     """, unsafe_allow_html=True)
 
 with col5:
-    diff = weekday_avg - weekend_avg
-    diff_text = f"週間高 {abs(diff):.1f}%" if diff > 0 else f"週末高 {abs(diff):.1f}%"
     st.markdown(f"""
     <div class="metric-card violet">
         <div class="metric-label">週間 vs 週末</div>
-        <div class="metric-value violet">{diff_text}</div>
-        <div class="metric-sub">週間 {weekday_avg:.1f}% / 週末 {weekend_avg:.1f}%</div>
+        <div class="metric-value violet">{summary['diff_text']}</div>
+        <div class="metric-sub">週間 {summary['weekday_avg']:.1f}% / 週末 {summary['weekend_avg']:.1f}%</div>
     </div>
     """, unsafe_allow_html=True)
 
 st.markdown("<br>", unsafe_allow_html=True)
 
-# ===== 趨勢圖處理 =====
-granularity_map = {"5 分鐘": "5min", "15 分鐘": "15min", "30 分鐘": "30min", "1 小時": "1h", "4 小時": "4h"}
-gran = granularity_map[time_granularity]
-df['taipei_time'] = pd.to_datetime(df['taipei_time'])
-trend_df = df.set_index('taipei_time').resample(gran).agg({'available_cars': 'mean', 'usage_rate': 'mean'}).reset_index()
-trend_df.columns = ['time', 'available', 'usage_rate']
-
 # ===== 主圖表：趨勢圖 =====
 st.subheader("📊 剩餘車位趨勢圖")
 
-if display_metric == "剩餘車位":
-    fig_main = go.Figure()
-    fig_main.add_trace(go.Scatter(
-        x=trend_df['time'],
-        y=trend_df['available'],
-        mode='lines',
-        fill='tozeroy',
-        line=dict(color='#22d3ee', width=3),
-        fillcolor='rgba(34, 211, 238, 0.1)',
-        name='剩餘車位'
-    ))
-    y_range = [0, total_cars * 1.1]
-    y_title = '剩餘車位'
-else:
-    fig_main = go.Figure()
-    fig_main.add_trace(go.Scatter(
-        x=trend_df['time'],
-        y=trend_df['usage_rate'],
-        mode='lines',
-        fill='tozeroy',
-        line=dict(color='#22d3ee', width=3),
-        fillcolor='rgba(34, 211, 238, 0.1)',
-        name='使用率'
-    ))
-    y_range = [0, 105]
-    y_title = '使用率 (%)'
-
-fig_main.update_layout(
-    paper_bgcolor='#1e293b',
-    plot_bgcolor='#1e293b',
-    font=dict(color='#e2e8f0', size=14),
-    margin=dict(l=40, r=40, t=20, b=40),
-    height=450,
-    yaxis_title=y_title,
-    xaxis_title='時間',
-    xaxis=dict(
-        gridcolor='rgba(51, 65, 85, 0.5)',
-        zerolinecolor='rgba(51, 65, 85, 0.5)',
-        tickfont=dict(size=16, color='white'),
-        title=dict(font=dict(size=16, color='white'))
-    ),
-    yaxis=dict(
-        gridcolor='rgba(51, 65, 85, 0.5)',
-        zerolinecolor='rgba(51, 65, 85, 0.5)',
-        range=y_range,
-        tickfont=dict(size=16, color='white'),
-        title=dict(font=dict(size=16, color='white'))
-    ),
-    hovermode='x unified'
-)
+# 預測只在資料期間包含今天時顯示（接在目前的資料後面）
+forecast_df = None
+forecast_hours = forecast.FORECAST_HORIZONS[forecast_horizon]
+if forecast_hours > 0:
+    now = forecast.taipei_now()
+    if end_date >= now.date():
+        with st.spinner('載入預測中...'):
+            forecast_params = get_forecast_params(forecast.params_version())
+        if forecast_params is None:
+            st.info("預測模型建立中（第一次需要讀取 90 天資料），請稍後重新整理。")
+        else:
+            forecast_df = forecast.predict(forecast_params, parking_lot_id, now, forecast_hours, total_cars)
+            if forecast_df['available'].isna().all():
+                st.info("這個停車場還沒有足夠的歷史資料可以預測。")
+    else:
+        st.info("預測只在資料期間包含今天時顯示，請把結束日期設為今天。")
+
+fig_main = charts.build_trend_figure(aggregates['trend'], display_metric, total_cars, forecast_df)
 st.plotly_chart(fig_main, use_container_width=True, config={'displayModeBar': True})
 
 # ===== 雙圖表區：時段分析 + 每日比較 =====
@@ -520,78 +675,13 @@ col_left, col_right = st.columns(2)
 with col_left:
     st.subheader("📊 各時段平均使用率")
 
-    hourly_df = df.groupby('hour').agg({'usage_rate': 'mean'}).reset_index()
-
-    fig_hourly = go.Figure()
-    fig_hourly.add_trace(go.Bar(
-        x=hourly_df['hour'],
-        y=hourly_df['usage_rate'],
-        marker=dict(color='#22d3ee'),
-        name='使用率'
-    ))
-    fig_hourly.update_layout(
-        paper_bgcolor='#1e293b',
-        plot_bgcolor='#1e293b',
-        font=dict(color='#e2e8f0', size=14),
-        margin=dict(l=40, r=40, t=20, b=40),
-        height=380,
-        yaxis_title='平均使用率 (%)',
-        xaxis_title='小時',
-        xaxis=dict(
-            tickmode='linear',
-            tick0=0,
-            dtick=2,
-            gridcolor='rgba(51, 65, 85, 0.5)',
-            tickfont=dict(size=16, color='white'),
-            title=dict(font=dict(size=16, color='white'))
-        ),
-        yaxis=dict(
-            gridcolor='rgba(51, 65, 85, 0.5)',
-            range=[0, 100],
-            tickfont=dict(size=16, color='white'),
-            title=dict(font=dict(size=16, color='white'))
-        )
-    )
+    fig_hourly = charts.build_hourly_figure(aggregates['hourly'])
     st.plotly_chart(fig_hourly, use_container_width=True, config={'displayModeBar': True})
 
 with col_right:
     st.subheader("📅 每日使用率比較")
 
-    daily_df = df.groupby(['date_str', 'day_of_week']).agg({'usage_rate': 'mean'}).reset_index()
-    daily_df['is_weekend'] = daily_df['day_of_week'].isin([1, 7])
-    day_names = ['', '日', '一', '二', '三', '四', '五', '六']
-    daily_df['label'] = daily_df.apply(lambda x: f"{x['date_str'][5:]} ({day_names[int(x['day_of_week'])]})", axis=1)
-
-    colors = ['#a78bfa' if w else '#22d3ee' for w in daily_df['is_weekend']]
-
-    fig_daily = go.Figure()
-    fig_daily.add_trace(go.Bar(
-        x=daily_df['label'],
-        y=daily_df['usage_rate'],
-        marker=dict(color=colors),
-        name='使用率'
-    ))
-    fig_daily.update_layout(
-        paper_bgcolor='#1e293b',
-        plot_bgcolor='#1e293b',
-        font=dict(color='#e2e8f0', size=14),
-        margin=dict(l=40, r=40, t=20, b=40),
-        height=380,
-        yaxis_title='平均使用率 (%)',
-        xaxis_title='日期',
-        xaxis=dict(
-            gridcolor='rgba(51, 65, 85, 0.5)',
-            tickangle=-45,
-            tickfont=dict(size=16, color='white'),
-            title=dict(font=dict(size=16, color='white'))
-        ),
-        yaxis=dict(
-            gridcolor='rgba(51, 65, 85, 0.5)',
-            range=[0, 100],
-            tickfont=dict(size=16, color='white'),
-            title=dict(font=dict(size=16, color='white'))
-        )
-    )
+    fig_daily = charts.build_daily_figure(aggregates['daily'])
     st.plotly_chart(fig_daily, use_container_width=True, config={'displayModeBar': True})
 
 # ===== 熱力圖（按星期×時段）=====
@@ -601,85 +691,13 @@ with st.container():
     # 切換顯示指標
     heatmap_metric = st.radio(
         "顯示指標",
-        ["平均使用率 (%)", "平均剩餘車位"],
+        [charts.HEATMAP_USAGE, charts.HEATMAP_AVAILABLE],
         index=0,
         horizontal=True,
         key="heatmap_metric"
     )
 
-    # BigQuery 的 day_of_week: 1=週日, 2=週一, ..., 7=週六
-    # 調整順序為週一到週日
-    weekday_order = [2, 3, 4, 5, 6, 7, 1]
-    weekday_names = {1: '週日', 2: '週一', 3: '週二', 4: '週三', 5: '週四', 6: '週五', 7: '週六'}
-
-    # 根據選擇的指標準備資料
-    if heatmap_metric == "平均使用率 (%)":
-        heatmap_data = df.groupby(['day_of_week', 'hour']).agg({'usage_rate': 'mean'}).reset_index()
-        heatmap_pivot = heatmap_data.pivot(index='day_of_week', columns='hour', values='usage_rate')
-        heatmap_pivot = heatmap_pivot.reindex(weekday_order)
-        zmin, zmax = 0, 100
-        colorbar_title = '使用率 (%)'
-        hover_label = '使用率'
-        hover_suffix = '%'
-        # 顏色：0%綠 → 100%紅（使用率越高越紅）
-        custom_colorscale = [
-            [0.0, '#10b981'], [0.6, '#10b981'],   # 0-60% 綠
-            [0.6, '#eab308'], [0.8, '#eab308'],   # 60-80% 黃
-            [0.8, '#f97316'], [0.9, '#f97316'],   # 80-90% 橙
-            [0.9, '#ef4444'], [0.95, '#ef4444'],  # 90-95% 紅
-            [0.95, '#7f1d1d'], [1.0, '#7f1d1d']   # 95%+ 深紅
-        ]
-    else:
-        heatmap_data = df.groupby(['day_of_week', 'hour']).agg({'available_cars': 'mean'}).reset_index()
-        heatmap_pivot = heatmap_data.pivot(index='day_of_week', columns='hour', values='available_cars')
-        heatmap_pivot = heatmap_pivot.reindex(weekday_order)
-        zmin, zmax = 0, total_cars
-        colorbar_title = '剩餘車位'
-        hover_label = '剩餘車位'
-        hover_suffix = '格'
-        # 顏色：0格紅 → 滿格綠（剩餘越少越紅，反向）
-        custom_colorscale = [
-            [0.0, '#7f1d1d'], [0.05, '#7f1d1d'],  # 0-5% 深紅
-            [0.05, '#ef4444'], [0.1, '#ef4444'],  # 5-10% 紅
-            [0.1, '#f97316'], [0.2, '#f97316'],   # 10-20% 橙
-            [0.2, '#eab308'], [0.4, '#eab308'],   # 20-40% 黃
-            [0.4, '#10b981'], [1.0, '#10b981']    # 40%+ 綠
-        ]
-
-    y_labels = [weekday_names[d] for d in weekday_order]
-
-    # 處理沒有資料的格子：顯示灰色空白
-    text_values = heatmap_pivot.copy()
-    text_values = text_values.round(0).astype('Int64').astype(str)  # Int64 支援 NaN
-    text_values = text_values.replace('<NA>', '')  # NaN 顯示為空白
-
-    fig_heatmap = go.Figure(data=go.Heatmap(
-        z=heatmap_pivot.values,
-        x=heatmap_pivot.columns,
-        y=y_labels,
-        colorscale=custom_colorscale,
-        zmin=zmin,
-        zmax=zmax,
-        text=text_values.values,
-        texttemplate='%{text}',
-        textfont=dict(size=11, color='white'),
-        colorbar=dict(title=dict(text=colorbar_title, side='right'), tickfont=dict(color='#e2e8f0')),
-        hovertemplate=f'星期: %{{y}}<br>時段: %{{x}}:00<br>{hover_label}: %{{z:.1f}}{hover_suffix}<extra></extra>',
-        xgap=1,  # 格子間隙，讓灰色背景更明顯
-        ygap=1
-    ))
-
-    fig_heatmap.update_layout(
-        paper_bgcolor='#1e293b',
-        plot_bgcolor='#1e293b',
-        font=dict(color='#e2e8f0', size=14),
-        margin=dict(l=40, r=40, t=40, b=40),
-        height=350,
-        xaxis_title='小時',
-        yaxis_title='星期',
-        xaxis=dict(tickmode='linear', tick0=0, dtick=1, gridcolor='rgba(51, 65, 85, 0.5)'),
-        yaxis=dict(gridcolor='rgba(51, 65, 85, 0.5)')
-    )
+    fig_heatmap = charts.build_heatmap_figure(aggregates['heatmap'][heatmap_metric], heatmap_metric, total_cars)
     st.plotly_chart(fig_heatmap, use_container_width=True, config={'displayModeBar': True})
 
     # 圖例說明（緊貼熱力圖下方）
@@ -715,71 +733,131 @@ st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
 with st.container():
     st.subheader("📈 週間 vs 週末 24小時使用率曲線")
 
-    weekday_hourly = df[~df['is_weekend']].groupby('hour')['usage_rate'].mean().reset_index()
-    weekend_hourly = df[df['is_weekend']].groupby('hour')['usage_rate'].mean().reset_index()
-
-    # X 軸刻度標籤
-    hour_labels = [f'{h}時' for h in range(24)]
-    # Hover 用的標籤（加上「時間：」前綴）
-    hour_hover_labels = [f'時間：{h}時' for h in range(24)]
-
-    fig_ww = go.Figure()
-    if not weekday_hourly.empty:
-        fig_ww.add_trace(go.Scatter(
-            x=hour_labels[:len(weekday_hourly)],  # 使用文字標籤
-            y=weekday_hourly['usage_rate'],
-            mode='lines+markers',
-            fill='tozeroy',
-            line=dict(color='#22d3ee', width=3),
-            marker=dict(color='#22d3ee', size=6),
-            fillcolor='rgba(34, 211, 238, 0.1)',
-            name='週間平均',
-            customdata=[hour_hover_labels[h] for h in weekday_hourly['hour']],
-            hovertemplate='%{y:.2f}%<extra></extra>'
-        ))
-    if not weekend_hourly.empty:
-        fig_ww.add_trace(go.Scatter(
-            x=hour_labels[:len(weekend_hourly)],  # 使用文字標籤
-            y=weekend_hourly['usage_rate'],
-            mode='lines+markers',
-            fill='tozeroy',
-            line=dict(color='#a78bfa', width=3),
-            marker=dict(color='#a78bfa', size=6),
-            fillcolor='rgba(167, 139, 250, 0.1)',
-            name='週末平均',
-            customdata=[hour_hover_labels[h] for h in weekend_hourly['hour']],
-            hovertemplate='%{y:.2f}%<extra></extra>'
-        ))
-
-    fig_ww.update_layout(
-        paper_bgcolor='#1e293b',
-        plot_bgcolor='#1e293b',
-        font=dict(color='#e2e8f0', size=14),
-        margin=dict(l=40, r=40, t=40, b=40),
-        height=380,
-        xaxis_title='時間',
-        yaxis_title='使用率 (%)',
-        xaxis=dict(
-            categoryorder='array',
-            categoryarray=hour_labels,
-            gridcolor='rgba(51, 65, 85, 0.5)',
-            tickfont=dict(size=16, color='white')
-        ),
-        yaxis=dict(gridcolor='rgba(51, 65, 85, 0.5)', range=[0, 100], tickfont=dict(size=16, color='white')),
-        legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5, font=dict(color='#e2e8f0')),
-        hovermode='x unified',
-        hoverlabel=dict(font_size=18, namelength=-1)
-    )
-
-    # 修改 unified hover 的標題格式
-    fig_ww.update_xaxes(ticklabelposition='outside', showspikes=True, spikemode='across', spikethickness=1)
+    fig_ww = charts.build_weekday_weekend_figure(aggregates['weekday_hourly'], aggregates['weekend_hourly'])
     st.plotly_chart(fig_ww, use_container_width=True, config={'displayModeBar': True})
 
+# ===== 滿位事件分析 =====
+st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
+
+with st.container():
+    st.subheader("🚗 滿位事件分析")
+
+    episodes = aggregates['episodes']
+    full_threshold = int(total_cars * saturation.FULL_RATIO)
+    day_count = max(len(aggregates['daily']), 1)
+    st.caption(f"剩餘車位連續 ≤ {full_threshold} 格（總車位的 {saturation.FULL_RATIO:.0%}）算一次滿位；資料中斷超過 15 分鐘時，事件會在中斷處切開。")
+
+    full_minutes = episodes['duration_min'].sum()
+    if episodes.empty:
+        longest_text, longest_sub = "無", "期間內沒有滿位"
+    else:
+        longest = episodes.loc[episodes['duration_min'].idxmax()]
+        longest_text = saturation.format_minutes(longest['duration_min'])
+        longest_sub = f"{longest['start'].strftime('%m/%d %H:%M')} 開始"
+
+    ep_col1, ep_col2, ep_col3 = st.columns(3)
+
+    with ep_col1:
+        st.markdown(f"""
+        <div class="metric-card rose">
+            <div class="metric-label">滿位次數</div>
+            <div class="metric-value rose">{len(episodes)} 次</div>
+            <div class="metric-sub">平均每天 {len(episodes) / day_count:.1f} 次</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+    with ep_col2:
+        st.markdown(f"""
+        <div class="metric-card amber">
+            <div class="metric-label">滿位總時數</div>
+            <div class="metric-value amber">{full_minutes / 60:.1f} 小時</div>
+            <div class="metric-sub">平均每天 {full_minutes / 60 / day_count:.1f} 小時</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+    with ep_col3:
+        st.markdown(f"""
+        <div class="metric-card violet">
+            <div class="metric-label">最長一次滿位</div>
+            <div class="metric-value violet">{longest_text}</div>
+            <div class="metric-sub">{longest_sub}</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+    ep_left, ep_right = st.columns(2)
+
+    with ep_left:
+        st.subheader("⏳ 滿位持續時間分布")
+        fig_duration = charts.build_episode_duration_figure(episodes)
+        st.plotly_chart(fig_duration, use_container_width=True, config={'displayModeBar': True})
+
+    with ep_right:
+        st.subheader("🕒 幾點開始滿位")
+        fig_start = charts.build_episode_start_figure(episodes)
+        st.plotly_chart(fig_start, use_container_width=True, config={'displayModeBar': True})
+
+    # 全市排行（所有停車場一起算，資料量較大，勾選才計算）
+    with st.expander("🏙️ 全市停車場滿位排行"):
+        if st.checkbox("計算全市所有停車場（需要較長時間）", key="city_saturation"):
+            with st.spinner('計算全市滿位事件中...'):
+                city_df = get_city_saturation(start_date, end_date, data_version, lots_version)
+            city_df = city_df.sort_values(['full_hours', 'episode_count'], ascending=False)
+            st.dataframe(
+                city_df.rename(columns={
+                    'parking_lot_id': '停車場代碼',
+                    'name': '停車場名稱',
+                    'area': '區域',
+                    'total_cars': '汽車總車位',
+                    'episode_count': '滿位次數',
+                    'full_hours': '滿位總時數',
+                    'median_min': '持續時間中位數（分）',
+                    'longest_min': '最長一次（分）',
+                    'top_start_hour': '最常開始滿位（時）',
+                    **{label: f'持續 {label}（次）' for label in saturation.DURATION_LABELS},
+                }).round(1),
+                hide_index=True,
+                use_container_width=True
+            )
+
+# ===== 資料異常紀錄 =====
+st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
+
+with st.container():
+    st.subheader("⚠️ 資料異常紀錄")
+    st.caption("剩餘車位超過總車位、數值連續 3 小時以上沒變（從停住的時間開始整段排除，滿位和幾乎全空除外）、或 5 分鐘內突然大幅跳動（一直到數值回到跳動前為止）的資料，已從上方所有圖表中排除。")
+
+    incidents = aggregates['incidents']
+    if incidents.empty:
+        st.success("所選期間內沒有偵測到異常資料。")
+    else:
+        st.dataframe(
+            format_incidents(incidents.drop(columns='parking_lot_id')),
+            hide_index=True,
+            use_container_width=True
+        )
+
+    # 全市即時監控（所有停車場的新快照，勾選才開始）
+    with st.expander("🛰️ 全市即時異常監控（最近 24 小時）"):
+        if st.checkbox("開始監控所有停車場", key="city_anomaly"):
+            with st.spinner('檢查新資料中...'):
+                city_incidents = poll_anomaly_monitor()
+            if city_incidents is None:
+                st.info("監控資料載入中（第一次需要讀取最近 24 小時的資料），請稍後重新整理。")
+            elif city_incidents.empty:
+                st.success("最近 24 小時沒有偵測到異常資料。")
+            else:
+                city_incidents = city_incidents.merge(parking_lots[['parking_lot_id', 'name']], on='parking_lot_id', how='left')
+                st.dataframe(
+                    format_incidents(city_incidents[['parking_lot_id', 'name', 'anomaly_type', 'start', 'end', 'readings', 'min_value', 'max_value']]),
+                    hide_index=True,
+                    use_container_width=True
+                )
+
 # ===== 頁尾 =====
 st.markdown(f"""
 <div class="footer">
-    資料更新時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | 
+    資料更新時間：{get_table_modified(parking_data.REALTIME_SPOTS_TABLE).astimezone(parking_data.TAIPEI_TZ).strftime('%Y-%m-%d %H:%M:%S')} | 
     資料範圍：{start_date} 至 {end_date} | 
-    共 {len(df):,} 筆資料
+    共 {aggregates['row_count']:,} 筆資料（已排除 {aggregates['masked_count']:,} 筆異常）
 </div>
 """, unsafe_allow_html=True)
@@ -0,0 +1,622 @@
+import pandas as pd
+import plotly.graph_objects as go
+
+import anomaly
+import saturation
+
+# ===== 共用設定 =====
+# 儀表板和報表匯出都用這裡的計算與圖表定義，確保兩邊畫出來的圖一模一樣
+GRANULARITY_MAP = {"5 分鐘": "5min", "15 分鐘": "15min", "30 分鐘": "30min", "1 小時": "1h", "4 小時": "4h"}
+
+# BigQuery 的 day_of_week: 1=週日, 2=週一, ..., 7=週六
+# 調整順序為週一到週日
+WEEKDAY_ORDER = [2, 3, 4, 5, 6, 7, 1]
+WEEKDAY_NAMES = {1: '週日', 2: '週一', 3: '週二', 4: '週三', 5: '週四', 6: '週五', 7: '週六'}
+DAY_NAMES = ['', '日', '一', '二', '三', '四', '五', '六']
+
+HEATMAP_USAGE = "平均使用率 (%)"
+HEATMAP_AVAILABLE = "平均剩餘車位"
+
+
+# ===== 數據計算 =====
+# 先把資料彙總成「日期 × 小時」的加總值和筆數，所有平均值都從這裡計算
+# 加總值可以直接相加：範圍包含今天時，已經不會變的歷史部分只要算一次，之後只算最近這一小段
+CELL_KEYS = ['date_str', 'day_of_week', 'hour']
+
+
+def compute_cells(df):
+    return df.assign(n=1).groupby(CELL_KEYS, as_index=False)[['available_cars', 'usage_rate', 'n']].sum()
+
+
+# 依 keys 分組的平均值（加總值 ÷ 筆數）
+def _cell_mean(cells, keys, column):
+    sums = cells.groupby(keys)[[column, 'n']].sum()
+    return (sums[column] / sums['n']).rename(column)
+
+
+def _overall_mean(cells, column):
+    n = cells['n'].sum()
+    return cells[column].sum() / n if n > 0 else float('nan')
+
+
+# 最高 / 最低剩餘車位和發生時間（同樣的數值取最早的一筆）
+def compute_extremes(df):
+    if df.empty:
+        return None
+    max_idx = df['available_cars'].idxmax()
+    min_idx = df['available_cars'].idxmin()
+    return {
+        'max_available': df.loc[max_idx, 'available_cars'],
+        'max_time': pd.to_datetime(df.loc[max_idx, 'taipei_time']),
+        'min_available': df.loc[min_idx, 'available_cars'],
+        'min_time': pd.to_datetime(df.loc[min_idx, 'taipei_time']),
+    }
+
+
+def compute_summary(cells, extremes):
+    avg_available = _overall_mean(cells, 'available_cars')
+    avg_usage = _overall_mean(cells, 'usage_rate')
+
+    hourly_avg = _cell_mean(cells, ['hour'], 'usage_rate')
+    peak_hours = hourly_avg[hourly_avg > 80].index.tolist()  # 將尖峰定義提高到 80%
+    if peak_hours:
+        peak_hours_str = f"{min(peak_hours)}:00-{max(peak_hours)+1}:00"
+    else:
+        peak_hours_str = "無"
+
+    is_weekend = cells['day_of_week'].isin([1, 7])
+    weekday_avg = _overall_mean(cells[~is_weekend], 'usage_rate')
+    weekend_avg = _overall_mean(cells[is_weekend], 'usage_rate')
+    if pd.isna(weekday_avg): weekday_avg = 0
+    if pd.isna(weekend_avg): weekend_avg = 0
+
+    diff = weekday_avg - weekend_avg
+    diff_text = f"週間高 {abs(diff):.1f}%" if diff > 0 else f"週末高 {abs(diff):.1f}%"
+
+    return {
+        'avg_available': avg_available,
+        'avg_usage': avg_usage,
+        'max_available': extremes['max_available'],
+        'min_available': extremes['min_available'],
+        'max_time': extremes['max_time'].strftime('%m/%d %H:%M'),
+        'min_time': extremes['min_time'].strftime('%m/%d %H:%M'),
+        'peak_hours_str': peak_hours_str,
+        'weekday_avg': weekday_avg,
+        'weekend_avg': weekend_avg,
+        'diff_text': diff_text,
+    }
+
+
+def compute_trend(df, gran):
+    trend_df = (
+        df.assign(taipei_time=pd.to_datetime(df['taipei_time']))
+        .set_index('taipei_time')
+        .resample(gran)
+        .agg({'available_cars': 'mean', 'usage_rate': 'mean'})
+        .reset_index()
+    )
+    trend_df.columns = ['time', 'available', 'usage_rate']
+    return trend_df
+
+
+def compute_daily(cells):
+    daily_df = _cell_mean(cells, ['date_str', 'day_of_week'], 'usage_rate').reset_index()
+    daily_df['is_weekend'] = daily_df['day_of_week'].isin([1, 7])
+    daily_df['label'] = daily_df.apply(lambda x: f"{x['date_str'][5:]} ({DAY_NAMES[int(x['day_of_week'])]})", axis=1)
+    return daily_df
+
+
+def compute_heatmap(cells, column):
+    heatmap_data = _cell_mean(cells, ['day_of_week', 'hour'], column).reset_index()
+    heatmap_pivot = heatmap_data.pivot(index='day_of_week', columns='hour', values=column)
+    return heatmap_pivot.reindex(WEEKDAY_ORDER)
+
+
+# ===== 部分彙總結果 =====
+# 一段資料（例如已經不會變的歷史資料）算出來的中間結果，可以和下一段接起來
+# state、pending（可省略）：上一段結果的 'state'（異常偵測狀態）和 'pending'，讓接起來的結果和整段一起算相同
+# complete=False：後面還會接資料，最後一段還沒確定是否凍結的資料先保留在 'pending'，不算進這一段
+# 兩段資料要在午夜切開，趨勢圖的時間區間才不會被切成兩半
+def compute_partial(df, gran, state=None, pending=None, complete=True):
+    detector = anomaly.AnomalyDetector(state)
+    flagged = anomaly.detect_history(df, detector, pending)
+    if complete:
+        pending = flagged.iloc[:0]
+    else:
+        flagged, pending = anomaly.split_pending(flagged, gran)
+    df = flagged.loc[~flagged['is_anomaly'], df.columns].reset_index(drop=True)
+    times = pd.to_datetime(df['taipei_time'])
+    return {
+        'cells': compute_cells(df),
+        'trend': compute_trend(df, gran),
+        'extremes': compute_extremes(df),
+        'episodes': saturation.find_episodes(df),
+        'first_time': times.min(),
+        'last_time': times.max(),
+        'anomalies': flagged.loc[flagged['is_anomaly'], ['parking_lot_id', 'taipei_time', 'available_cars', 'is_anomaly', 'anomaly_type']],
+        'row_count': len(df),
+        'masked_count': int(flagged['is_anomaly'].sum()),
+        'state': detector.state,
+        'pending': pending,
+    }
+
+
+def _concat(before, after):
+    if before.empty:
+        return after
+    if after.empty:
+        return before
+    return pd.concat([before, after], ignore_index=True)
+
+
+# 接起時間相鄰的兩段部分彙總結果（before 在前、after 在後）
+def merge_partials(before, after, gran):
+    if before['row_count'] == 0:
+        extremes = after['extremes']
+    elif after['row_count'] == 0:
+        extremes = before['extremes']
+    else:
+        # 同樣的數值取較早的一筆
+        high = max(before, after, key=lambda p: (p['extremes']['max_available'], -p['extremes']['max_time'].value))
+        low = min(before, after, key=lambda p: (p['extremes']['min_available'], p['extremes']['min_time'].value))
+        extremes = {
+            'max_available': high['extremes']['max_available'],
+            'max_time': high['extremes']['max_time'],
+            'min_available': low['extremes']['min_available'],
+            'min_time': low['extremes']['min_time'],
+        }
+
+    # 趨勢圖：兩段中間沒有資料的時間區間補成空值（和整段一起 resample 相同）
+    trend = _concat(before['trend'], after['trend'])
+    if not before['trend'].empty and not after['trend'].empty:
+        trend = trend.set_index('time').asfreq(gran).reset_index()
+
+    return {
+        'cells': _concat(before['cells'], after['cells']).groupby(CELL_KEYS, as_index=False)[['available_cars', 'usage_rate', 'n']].sum(),
+        'trend': trend,
+        'extremes': extremes,
+        'episodes': saturation.concat_episodes(before['episodes'], before['last_time'], after['episodes'], after['first_time']),
+        'first_time': before['first_time'] if before['row_count'] else after['first_time'],
+        'last_time': after['last_time'] if after['row_count'] else before['last_time'],
+        'anomalies': _concat(before['anomalies'], after['anomalies']),
+        'row_count': before['row_count'] + after['row_count'],
+        'masked_count': before['masked_count'] + after['masked_count'],
+        'state': after['state'],
+        'pending': after['pending'],
+    }
+
+
+# 從部分彙總結果算出所有圖表需要的資料；排除異常後沒有資料時回傳 None
+def finalize_aggregates(partial):
+    if partial['row_count'] == 0:
+        return None
+
+    cells = partial['cells']
+    is_weekend = cells['day_of_week'].isin([1, 7])
+    return {
+        'summary': compute_summary(cells, partial['extremes']),
+        'trend': partial['trend'],
+        'hourly': _cell_mean(cells, ['hour'], 'usage_rate').reset_index(),
+        'daily': compute_daily(cells),
+        'heatmap': {
+            HEATMAP_USAGE: compute_heatmap(cells, 'usage_rate'),
+            HEATMAP_AVAILABLE: compute_heatmap(cells, 'available_cars'),
+        },
+        'weekday_hourly': _cell_mean(cells[~is_weekend], ['hour'], 'usage_rate').reset_index(),
+        'weekend_hourly': _cell_mean(cells[is_weekend], ['hour'], 'usage_rate').reset_index(),
+        'episodes': partial['episodes'],
+        'row_count': partial['row_count'],
+        'incidents': anomaly.group_incidents(partial['anomalies']),
+        'masked_count': partial['masked_count'],
+    }
+
+
+# 一次算好一個停車場所有圖表需要的彙總結果（可被快取，也可被報表匯出重複使用）
+# 先排除感測器異常的資料再計算；排除後沒有資料時回傳 None
+def compute_aggregates(df, gran):
+    return finalize_aggregates(compute_partial(df, gran))
+
+
+# ===== 主圖表：趨勢圖 =====
+# forecast_df（可省略）：forecast.predict 的結果，畫成虛線 + 預測區間
+def build_trend_figure(trend_df, display_metric, total_cars, forecast_df=None):
+    fig_main = go.Figure()
+    if display_metric == "剩餘車位":
+        fig_main.add_trace(go.Scatter(
+            x=trend_df['time'],
+            y=trend_df['available'],
+            mode='lines',
+            fill='tozeroy',
+            line=dict(color='#22d3ee', width=3),
+            fillcolor='rgba(34, 211, 238, 0.1)',
+            name='剩餘車位'
+        ))
+        y_range = [0, total_cars * 1.1]
+        y_title = '剩餘車位'
+    else:
+        fig_main.add_trace(go.Scatter(
+            x=trend_df['time'],
+            y=trend_df['usage_rate'],
+            mode='lines',
+            fill='tozeroy',
+            line=dict(color='#22d3ee', width=3),
+            fillcolor='rgba(34, 211, 238, 0.1)',
+            name='使用率'
+        ))
+        y_range = [0, 105]
+        y_title = '使用率 (%)'
+
+    if forecast_df is not None and not forecast_df.empty:
+        if display_metric == "剩餘車位":
+            y_mid, y_low, y_high = forecast_df['available'], forecast_df['lower'], forecast_df['upper']
+        else:
+            # 剩餘車位越多，使用率越低，所以上下界要對調
+            def to_usage(available):
+                return ((total_cars - available) / total_cars * 100).round(1)
+            y_mid, y_low, y_high = to_usage(forecast_df['available']), to_usage(forecast_df['upper']), to_usage(forecast_df['lower'])
+
+        fig_main.add_trace(go.Scatter(
+            x=forecast_df['time'],
+            y=y_high,
+            mode='lines',
+            line=dict(width=0),
+            hoverinfo='skip',
+            showlegend=False
+        ))
+        fig_main.add_trace(go.Scatter(
+            x=forecast_df['time'],
+            y=y_low,
+            mode='lines',
+            fill='tonexty',
+            line=dict(width=0),
+            fillcolor='rgba(251, 191, 36, 0.15)',
+            name='預測區間 (80%)'
+        ))
+        fig_main.add_trace(go.Scatter(
+            x=forecast_df['time'],
+            y=y_mid,
+            mode='lines',
+            line=dict(color='#fbbf24', width=3, dash='dash'),
+            name='預測'
+        ))
+
+    fig_main.update_layout(
+        paper_bgcolor='#1e293b',
+        plot_bgcolor='#1e293b',
+        font=dict(color='#e2e8f0', size=14),
+        margin=dict(l=40, r=40, t=20, b=40),
+        height=450,
+        yaxis_title=y_title,
+        xaxis_title='時間',
+        xaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            zerolinecolor='rgba(51, 65, 85, 0.5)',
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        ),
+        yaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            zerolinecolor='rgba(51, 65, 85, 0.5)',
+            range=y_range,
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        ),
+        hovermode='x unified'
+    )
+    return fig_main
+
+
+# ===== 各時段平均使用率 =====
+def build_hourly_figure(hourly_df):
+    fig_hourly = go.Figure()
+    fig_hourly.add_trace(go.Bar(
+        x=hourly_df['hour'],
+        y=hourly_df['usage_rate'],
+        marker=dict(color='#22d3ee'),
+        name='使用率'
+    ))
+    fig_hourly.update_layout(
+        paper_bgcolor='#1e293b',
+        plot_bgcolor='#1e293b',
+        font=dict(color='#e2e8f0', size=14),
+        margin=dict(l=40, r=40, t=20, b=40),
+        height=380,
+        yaxis_title='平均使用率 (%)',
+        xaxis_title='小時',
+        xaxis=dict(
+            tickmode='linear',
+            tick0=0,
+            dtick=2,
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        ),
+        yaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            range=[0, 100],
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        )
+    )
+    return fig_hourly
+
+
+# ===== 每日使用率比較 =====
+def build_daily_figure(daily_df):
+    colors = ['#a78bfa' if w else '#22d3ee' for w in daily_df['is_weekend']]
+
+    fig_daily = go.Figure()
+    fig_daily.add_trace(go.Bar(
+        x=daily_df['label'],
+        y=daily_df['usage_rate'],
+        marker=dict(color=colors),
+        name='使用率'
+    ))
+    fig_daily.update_layout(
+        paper_bgcolor='#1e293b',
+        plot_bgcolor='#1e293b',
+        font=dict(color='#e2e8f0', size=14),
+        margin=dict(l=40, r=40, t=20, b=40),
+        height=380,
+        yaxis_title='平均使用率 (%)',
+        xaxis_title='日期',
+        xaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            tickangle=-45,
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        ),
+        yaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            range=[0, 100],
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        )
+    )
+    return fig_daily
+
+
+# ===== 熱力圖（按星期×時段）=====
+def build_heatmap_figure(heatmap_pivot, heatmap_metric, total_cars):
+    if heatmap_metric == HEATMAP_USAGE:
+        zmin, zmax = 0, 100
+        colorbar_title = '使用率 (%)'
+        hover_label = '使用率'
+        hover_suffix = '%'
+        # 顏色：0%綠 → 100%紅（使用率越高越紅）
+        custom_colorscale = [
+            [0.0, '#10b981'], [0.6, '#10b981'],   # 0-60% 綠
+            [0.6, '#eab308'], [0.8, '#eab308'],   # 60-80% 黃
+            [0.8, '#f97316'], [0.9, '#f97316'],   # 80-90% 橙
+            [0.9, '#ef4444'], [0.95, '#ef4444'],  # 90-95% 紅
+            [0.95, '#7f1d1d'], [1.0, '#7f1d1d']   # 95%+ 深紅
+        ]
+    else:
+        zmin, zmax = 0, total_cars
+        colorbar_title = '剩餘車位'
+        hover_label = '剩餘車位'
+        hover_suffix = '格'
+        # 顏色：0格紅 → 滿格綠（剩餘越少越紅，反向）
+        custom_colorscale = [
+            [0.0, '#7f1d1d'], [0.05, '#7f1d1d'],  # 0-5% 深紅
+            [0.05, '#ef4444'], [0.1, '#ef4444'],  # 5-10% 紅
+            [0.1, '#f97316'], [0.2, '#f97316'],   # 10-20% 橙
+            [0.2, '#eab308'], [0.4, '#eab308'],   # 20-40% 黃
+            [0.4, '#10b981'], [1.0, '#10b981']    # 40%+ 綠
+        ]
+
+    y_labels = [WEEKDAY_NAMES[d] for d in WEEKDAY_ORDER]
+
+    # 處理沒有資料的格子：顯示灰色空白
+    text_values = heatmap_pivot.copy()
+    text_values = text_values.round(0).astype('Int64').astype(str)  # Int64 支援 NaN
+    text_values = text_values.replace('<NA>', '')  # NaN 顯示為空白
+
+    fig_heatmap = go.Figure(data=go.Heatmap(
+        z=heatmap_pivot.values,
+        x=heatmap_pivot.columns,
+        y=y_labels,
+        colorscale=custom_colorscale,
+        zmin=zmin,
+        zmax=zmax,
+        text=text_values.values,
+        texttemplate='%{text}',
+        textfont=dict(size=11, color='white'),
+        colorbar=dict(title=dict(text=colorbar_title, side='right'), tickfont=dict(color='#e2e8f0')),
+        hovertemplate=f'星期: %{{y}}<br>時段: %{{x}}:00<br>{hover_label}: %{{z:.1f}}{hover_suffix}<extra></extra>',
+        xgap=1,  # 格子間隙，讓灰色背景更明顯
+        ygap=1
+    ))
+
+    fig_heatmap.update_layout(
+        paper_bgcolor='#1e293b',
+        plot_bgcolor='#1e293b',
+        font=dict(color='#e2e8f0', size=14),
+        margin=dict(l=40, r=40, t=40, b=40),
+        height=350,
+        xaxis_title='小時',
+        yaxis_title='星期',
+        xaxis=dict(tickmode='linear', tick0=0, dtick=1, gridcolor='rgba(51, 65, 85, 0.5)'),
+        yaxis=dict(gridcolor='rgba(51, 65, 85, 0.5)')
+    )
+    return fig_heatmap
+
+
+# ===== 週間 vs 週末 24小時使用率曲線 =====
+def build_weekday_weekend_figure(weekday_hourly, weekend_hourly):
+    # X 軸刻度標籤
+    hour_labels = [f'{h}時' for h in range(24)]
+    # Hover 用的標籤（加上「時間：」前綴）
+    hour_hover_labels = [f'時間：{h}時' for h in range(24)]
+
+    fig_ww = go.Figure()
+    if not weekday_hourly.empty:
+        fig_ww.add_trace(go.Scatter(
+            x=hour_labels[:len(weekday_hourly)],  # 使用文字標籤
+            y=weekday_hourly['usage_rate'],
+            mode='lines+markers',
+            fill='tozeroy',
+            line=dict(color='#22d3ee', width=3),
+            marker=dict(color='#22d3ee', size=6),
+            fillcolor='rgba(34, 211, 238, 0.1)',
+            name='週間平均',
+            customdata=[hour_hover_labels[h] for h in weekday_hourly['hour']],
+            hovertemplate='%{y:.2f}%<extra></extra>'
+        ))
+    if not weekend_hourly.empty:
+        fig_ww.add_trace(go.Scatter(
+            x=hour_labels[:len(weekend_hourly)],  # 使用文字標籤
+            y=weekend_hourly['usage_rate'],
+            mode='lines+markers',
+            fill='tozeroy',
+            line=dict(color='#a78bfa', width=3),
+            marker=dict(color='#a78bfa', size=6),
+            fillcolor='rgba(167, 139, 250, 0.1)',
+            name='週末平均',
+            customdata=[hour_hover_labels[h] for h in weekend_hourly['hour']],
+            hovertemplate='%{y:.2f}%<extra></extra>'
+        ))
+
+    fig_ww.update_layout(
+        paper_bgcolor='#1e293b',
+        plot_bgcolor='#1e293b',
+        font=dict(color='#e2e8f0', size=14),
+        margin=dict(l=40, r=40, t=40, b=40),
+        height=380,
+        xaxis_title='時間',
+        yaxis_title='使用率 (%)',
+        xaxis=dict(
+            categoryorder='array',
+            categoryarray=hour_labels,
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            tickfont=dict(size=16, color='white')
+        ),
+        yaxis=dict(gridcolor='rgba(51, 65, 85, 0.5)', range=[0, 100], tickfont=dict(size=16, color='white')),
+        legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5, font=dict(color='#e2e8f0')),
+        hovermode='x unified',
+        hoverlabel=dict(font_size=18, namelength=-1)
+    )
+
+    # 修改 unified hover 的標題格式
+    fig_ww.update_xaxes(ticklabelposition='outside', showspikes=True, spikemode='across', spikethickness=1)
+    return fig_ww
+
+
+# ===== 滿位事件：持續時間分布 =====
+def build_episode_duration_figure(episodes):
+    counts = saturation.duration_histogram(episodes).sum()
+
+    fig_duration = go.Figure()
+    fig_duration.add_trace(go.Bar(
+        x=counts.index,
+        y=counts.values,
+        marker=dict(color='#fb7185'),
+        name='事件數',
+        hovertemplate='%{x}<br>%{y} 次<extra></extra>'
+    ))
+    fig_duration.update_layout(
+        paper_bgcolor='#1e293b',
+        plot_bgcolor='#1e293b',
+        font=dict(color='#e2e8f0', size=14),
+        margin=dict(l=40, r=40, t=20, b=40),
+        height=380,
+        yaxis_title='滿位次數',
+        xaxis_title='持續時間',
+        xaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        ),
+        yaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            rangemode='tozero',
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        )
+    )
+    return fig_duration
+
+
+# ===== 滿位事件：開始時段分布 =====
+def build_episode_start_figure(episodes):
+    counts = saturation.start_hour_distribution(episodes).sum().reindex(range(24), fill_value=0)
+
+    fig_start = go.Figure()
+    fig_start.add_trace(go.Bar(
+        x=counts.index,
+        y=counts.values,
+        marker=dict(color='#fbbf24'),
+        name='事件數',
+        hovertemplate='%{x}時開始<br>%{y} 次<extra></extra>'
+    ))
+    fig_start.update_layout(
+        paper_bgcolor='#1e293b',
+        plot_bgcolor='#1e293b',
+        font=dict(color='#e2e8f0', size=14),
+        margin=dict(l=40, r=40, t=20, b=40),
+        height=380,
+        yaxis_title='滿位次數',
+        xaxis_title='開始滿位的小時',
+        xaxis=dict(
+            tickmode='linear',
+            tick0=0,
+            dtick=2,
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        ),
+        yaxis=dict(
+            gridcolor='rgba(51, 65, 85, 0.5)',
+            rangemode='tozero',
+            tickfont=dict(size=16, color='white'),
+            title=dict(font=dict(size=16, color='white'))
+        )
+    )
+    return fig_start
+
+
+# ===== 指標卡片（報表用的靜態版本）=====
+# 儀表板用 HTML 卡片；匯出報表時改用表格圖，內容和卡片相同
+def build_summary_figure(summary, title):
+    labels = ['平均剩餘車位', '最高剩餘車位', '最低剩餘車位（滿位）', '尖峰時段', '週間 vs 週末']
+    values = [
+        f"{summary['avg_available']:.0f}",
+        f"{summary['max_available']:.0f}",
+        f"{summary['min_available']:.0f}",
+        summary['peak_hours_str'],
+        summary['diff_text'],
+    ]
+    subs = [
+        f"平均使用率：{summary['avg_usage']:.1f}%",
+        summary['max_time'],
+        summary['min_time'],
+        '使用率 > 80%',
+        f"週間 {summary['weekday_avg']:.1f}% / 週末 {summary['weekend_avg']:.1f}%",
+    ]
+    colors = ['#22d3ee', '#34d399', '#fb7185', '#fbbf24', '#a78bfa']
+
+    fig_summary = go.Figure(data=go.Table(
+        header=dict(
+            values=labels,
+            fill_color='#1e293b',
+            line_color='#334155',
+            font=dict(color='#cbd5e1', size=16),
+            align='center',
+            height=36
+        ),
+        cells=dict(
+            values=[[v, s] for v, s in zip(values, subs)],
+            fill_color='#1e293b',
+            line_color='#334155',
+            font=dict(color=colors, size=20),
+            align='center',
+            height=40
+        )
+    ))
+    fig_summary.update_layout(
+        title=dict(text=title, font=dict(size=22, color='white'), x=0.5),
+        paper_bgcolor='#0f172a',
+        margin=dict(l=20, r=20, t=60, b=10),
+        height=220
+    )
+    return fig_summary
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+import charts
+
+# ===== 檢查：拆成兩段計算再合併 = 整段一起計算 =====
+# 儀表板在範圍包含今天時，把「已經不會變的歷史部分」和「最近這一小段」分開計算再合併（見 app.py get_lot_aggregates）
+# 這裡用人造資料檢查合併後的結果和整段一起算完全相同，
+# 特別是跨過午夜的突然跳動、數值凍結、滿位事件（異常偵測狀態要正確接到下一段）
+# 範例：python check_aggregates.py（全部相同時印出 OK，不同時會丟出 AssertionError）
+TOTAL_CARS = 200
+START = pd.Timestamp("2026-03-02")   # 週一
+DAYS = 4
+
+
+def make_snapshots():
+    times = pd.date_range(START, periods=DAYS * 288, freq="5min")
+    rng = np.random.default_rng(0)
+    hours = times.hour + times.minute / 60
+    available = np.round(100 + 60 * np.sin(hours / 24 * 2 * np.pi) + rng.normal(0, 3, len(times)))
+    df = pd.DataFrame({'taipei_time': times, 'available_cars': available.astype(int)})
+
+    def between(start, end):
+        return (df['taipei_time'] >= START + pd.Timedelta(start)) & (df['taipei_time'] < START + pd.Timedelta(end))
+
+    # 第 1 個午夜：突然跳到 5 格，00:15 回到原本的數值
+    df.loc[between("23h50min", "24h15min"), 'available_cars'] = 5
+    # 第 2 個午夜：22:00 起數值凍結 4 小時（凌晨 1:00 才超過 3 小時）
+    df.loc[between("1D22h", "2D2h"), 'available_cars'] = 77
+    # 第 3 個午夜：慢慢停滿，23:30 ~ 00:30 滿位，再慢慢空出來
+    filling = between("2D22h30min", "2D23h30min")
+    df.loc[filling, 'available_cars'] = np.linspace(100, 10, filling.sum()).round().astype(int)
+    df.loc[between("2D23h30min", "3D0h30min"), 'available_cars'] = 2
+    leaving = between("3D0h30min", "3D1h30min")
+    df.loc[leaving, 'available_cars'] = np.linspace(10, 100, leaving.sum()).round().astype(int)
+    # 中間有一段資料中斷
+    df = df[~between("1D9h", "1D9h30min")]
+
+    times = df['taipei_time']
+    return pd.DataFrame({
+        'taipei_time': times,
+        'available_cars': df['available_cars'],
+        'total_cars': TOTAL_CARS,
+        'used_cars': TOTAL_CARS - df['available_cars'],
+        'usage_rate': ((TOTAL_CARS - df['available_cars']) / TOTAL_CARS * 100).round(1),
+        'hour': times.dt.hour,
+        'day_of_week': (times.dt.dayofweek + 1) % 7 + 1,
+        'date_str': times.dt.strftime('%Y-%m-%d'),
+    }).reset_index(drop=True)
+
+
+def assert_same(expected, actual, path="aggregates"):
+    if expected is None or actual is None:
+        assert expected is None and actual is None, path
+    elif isinstance(expected, dict):
+        assert expected.keys() == actual.keys(), path
+        for key in expected:
+            assert_same(expected[key], actual[key], f"{path}.{key}")
+    elif isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(
+            expected.reset_index(drop=True), actual.reset_index(drop=True),
+            check_dtype=False, check_exact=False, rtol=1e-9, obj=path,
+        )
+    elif isinstance(expected, float):
+        assert np.isclose(expected, actual, rtol=1e-9), (path, expected, actual)
+    else:
+        assert expected == actual, (path, expected, actual)
+
+
+def split_and_merge(df, split_day, gran):
+    times = pd.to_datetime(df['taipei_time'])
+    history = charts.compute_partial(df[times < split_day].reset_index(drop=True), gran, complete=False)
+    recent = charts.compute_partial(df[times >= split_day].reset_index(drop=True), gran, history['state'], history['pending'])
+    return charts.finalize_aggregates(charts.merge_partials(history, recent, gran))
+
+
+def main():
+    df = make_snapshots()
+    for gran in charts.GRANULARITY_MAP.values():
+        expected = charts.compute_aggregates(df, gran)
+        for day in range(1, DAYS):
+            assert_same(expected, split_and_merge(df, START + pd.Timedelta(days=day), gran), f"{gran} 第 {day} 天切開")
+
+    # 確認人造資料真的有測到跨午夜的情況
+    expected = charts.compute_aggregates(df, "1h")
+    incidents = expected['incidents'].set_index('anomaly_type')
+    assert {'jump', 'frozen'} <= set(incidents.index), incidents
+    # 凍結從數值停住的時間開始算
+    assert incidents.loc['frozen', 'start'] == START + pd.Timedelta("1D22h"), incidents
+    episodes = expected['episodes']
+    assert (episodes['start'].dt.date != episodes['end'].dt.date).any(), "沒有跨午夜的滿位事件"
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import anomaly
+import parking_data
+
+# ===== 預測模型設定 =====
+# 模型：剩餘車位 = 各「星期 × 小時」的基準值 + 每個停車場的長期趨勢（每天增減幾格）
+#
+# 為什麼這樣設計：
+# - 每個格子（停車場 × 星期 × 小時）只存幾個加總值（筆數、Σt、Σy...），
+#   新的一天進來時把加總值加上去就好，不用重新讀全部歷史資料
+# - 所有停車場一起用 pandas groupby 計算，不用一個一個跑迴圈
+# - 舊資料會依半衰期慢慢降低權重，讓模型跟得上最近的變化
+# - 訓練前先用 anomaly.py 排除感測器異常的快照，和儀表板上的圖表用同樣的資料
+MODEL_DIR = os.environ.get("FORECAST_MODEL_DIR", "forecast_models")
+STATS_FILE = "cell_stats.parquet"
+PARAMS_FILE = "params.parquet"
+DETECTOR_FILE = "detector_state.parquet"
+PENDING_FILE = "pending_snapshots.parquet"
+META_FILE = "meta.json"
+
+ORIGIN = pd.Timestamp("2025-01-01")  # 時間 t 的起點（單位：天），避免數字太大
+HALF_LIFE_DAYS = 56                  # 8 週前的資料權重剩一半
+INITIAL_DAYS = 90                    # 第一次建立模型時讀取的天數
+FETCH_DAYS = 7                       # 每次查詢幾天的原始快照（第一次建立模型時分段讀取，記憶體用量才不會太大）
+INTERVAL_Z = 1.28                    # 80% 預測區間
+
+CELL_KEYS = ['parking_lot_id', 'day_of_week', 'hour']
+STAT_COLUMNS = ['n', 'sum_t', 'sum_tt', 'sum_y', 'sum_yy', 'sum_ty']
+
+FORECAST_HORIZONS = {"不顯示": 0, "24 小時": 24, "3 天": 72, "7 天": 168}
+
+
+# ===== 台北今天的日期 =====
+def taipei_now():
+    return datetime.now(parking_data.TAIPEI_TZ).replace(tzinfo=None)
+
+
+def _day_of_week(times):
+    # 和 BigQuery 相同：1=週日, 2=週一, ..., 7=週六
+    return (times.dt.dayofweek + 1) % 7 + 1
+
+
+# ===== 原始快照 → 每小時平均 =====
+# snapshots 欄位：parking_lot_id、taipei_time、available_cars、total_cars
+# detector、pending 接著上一段資料繼續偵測，排除異常後再算平均
+# 還沒確定是否凍結的最後幾個小時先不算，回傳（每小時平均, 保留給下一段的快照）
+def compute_hourly(snapshots, detector, pending=None):
+    flagged = anomaly.detect_history(snapshots, detector, pending)
+    flagged, pending = anomaly.split_pending(flagged, 'h')
+    clean = flagged[~flagged['is_anomaly']]
+    hourly = (
+        clean.assign(hour_start=pd.to_datetime(clean['taipei_time']).dt.floor('h'))
+        .groupby(['parking_lot_id', 'hour_start'], as_index=False)['available_cars'].mean()
+    )
+    return hourly, pending
+
+
+# ===== 把每小時資料轉成每個格子的加總值 =====
+# hourly 欄位：parking_lot_id、hour_start、available_cars
+# weight_through 之前越久的資料權重越低（和 decay_stats 的衰減方式一致）
+def compute_cell_stats(hourly, weight_through):
+    hour_start = pd.to_datetime(hourly['hour_start'])
+    t = ((hour_start - ORIGIN) / pd.Timedelta(days=1)).to_numpy()
+    y = hourly['available_cars'].astype(float).to_numpy()
+    age_days = ((pd.Timestamp(weight_through) - hour_start.dt.normalize()) / pd.Timedelta(days=1)).to_numpy()
+    w = 0.5 ** (age_days / HALF_LIFE_DAYS)
+
+    frame = pd.DataFrame({
+        'parking_lot_id': hourly['parking_lot_id'].to_numpy(),
+        'day_of_week': _day_of_week(hour_start).to_numpy(),
+        'hour': hour_start.dt.hour.to_numpy(),
+        'n': w,
+        'sum_t': w * t,
+        'sum_tt': w * t * t,
+        'sum_y': w * y,
+        'sum_yy': w * y * y,
+        'sum_ty': w * t * y,
+    })
+    return frame.groupby(CELL_KEYS, as_index=False)[STAT_COLUMNS].sum()
+
+
+# 舊的加總值依經過天數降低權重
+def decay_stats(stats, days):
+    decayed = stats.copy()
+    decayed[STAT_COLUMNS] = decayed[STAT_COLUMNS] * 0.5 ** (days / HALF_LIFE_DAYS)
+    return decayed
+
+
+def merge_stats(old_stats, new_stats):
+    if old_stats is None or old_stats.empty:
+        return new_stats
+    return pd.concat([old_stats, new_stats]).groupby(CELL_KEYS, as_index=False)[STAT_COLUMNS].sum()
+
+
+# ===== 從加總值算出模型參數 =====
+# 每個停車場一條共同的趨勢線（斜率），每個格子一個基準值和標準差
+# 斜率用「格子內去平均」後的最小平方法，等同於「星期 × 小時」虛擬變數 + 線性趨勢的迴歸
+def fit_params(stats):
+    s = stats
+    sxx = s['sum_tt'] - s['sum_t'] ** 2 / s['n']
+    sxy = s['sum_ty'] - s['sum_t'] * s['sum_y'] / s['n']
+    lot_sums = pd.DataFrame({'parking_lot_id': s['parking_lot_id'], 'sxx': sxx, 'sxy': sxy}).groupby('parking_lot_id').sum()
+    lot_slope = (lot_sums['sxy'] / lot_sums['sxx']).where(lot_sums['sxx'] > 1e-9, 0.0)
+
+    slope = s['parking_lot_id'].map(lot_slope).to_numpy()
+    level = (s['sum_y'] - slope * s['sum_t']) / s['n']
+    sse = (
+        s['sum_yy']
+        - 2 * level * s['sum_y']
+        - 2 * slope * s['sum_ty']
+        + s['n'] * level ** 2
+        + 2 * slope * level * s['sum_t']
+        + slope ** 2 * s['sum_tt']
+    )
+    sigma = np.sqrt(sse.clip(lower=0) / (s['n'] - 1).clip(lower=1))
+
+    return pd.DataFrame({
+        'parking_lot_id': s['parking_lot_id'],
+        'day_of_week': s['day_of_week'],
+        'hour': s['hour'],
+        'level': level,
+        'slope': slope,
+        'sigma': sigma,
+        'n': s['n'],
+    })
+
+
+# ===== 讀取 / 儲存模型 =====
+def load_meta(model_dir=MODEL_DIR):
+    path = os.path.join(model_dir, META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_stats(model_dir=MODEL_DIR):
+    path = os.path.join(model_dir, STATS_FILE)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def load_params(model_dir=MODEL_DIR):
+    path = os.path.join(model_dir, PARAMS_FILE)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+# 上次更新結束時的異常偵測狀態；沒有時從頭開始
+def load_detector(model_dir=MODEL_DIR):
+    path = os.path.join(model_dir, DETECTOR_FILE)
+    if not os.path.exists(path):
+        return anomaly.AnomalyDetector()
+    return anomaly.AnomalyDetector(pd.read_parquet(path))
+
+
+# 上次更新結束時還沒確定是否凍結的快照；沒有時是 None
+def load_pending(model_dir=MODEL_DIR):
+    path = os.path.join(model_dir, PENDING_FILE)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+# 目前模型訓練到哪一天；還沒建立模型時是 None
+# 儀表板把它放進快取的 key，排程更新模型後才重新讀取參數
+def params_version(model_dir=MODEL_DIR):
+    meta = load_meta(model_dir)
+    return None if meta is None else meta['fitted_through']
+
+
+# 先寫暫存檔再換名，儀表板同時讀取時不會讀到寫一半的檔案
+def _write_atomic(path, write):
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_json(data, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+def save_model(stats, params, detector, pending, fitted_through, model_dir=MODEL_DIR):
+    os.makedirs(model_dir, exist_ok=True)
+    _write_atomic(os.path.join(model_dir, STATS_FILE), lambda path: stats.to_parquet(path, index=False))
+    _write_atomic(os.path.join(model_dir, PARAMS_FILE), lambda path: params.to_parquet(path, index=False))
+    _write_atomic(os.path.join(model_dir, DETECTOR_FILE), detector.state.to_parquet)
+    if pending is not None:
+        _write_atomic(os.path.join(model_dir, PENDING_FILE), lambda path: pending.to_parquet(path, index=False))
+    # meta 最後寫，代表這一版模型已經完整存好
+    meta = {'fitted_through': fitted_through.isoformat(), 'updated_at': taipei_now().isoformat(timespec='seconds')}
+    _write_atomic(os.path.join(model_dir, META_FILE), lambda path: _write_json(meta, path))
+
+
+# ===== 增量更新模型 =====
+# 只讀取上次更新之後「已經結束」的日子（今天還沒過完，不納入）
+# 回傳 True 代表有更新
+def refresh_model(client, model_dir=MODEL_DIR, today=None):
+    today = today or taipei_now().date()
+    through = today - timedelta(days=1)
+
+    # 沒有 meta 或加總值檔案不見了，都當成第一次建立模型
+    meta = load_meta(model_dir)
+    old_stats = None if meta is None else load_stats(model_dir)
+    if old_stats is None:
+        detector = anomaly.AnomalyDetector()
+        pending = None
+        start = through - timedelta(days=INITIAL_DAYS - 1)
+    else:
+        fitted_through = date.fromisoformat(meta['fitted_through'])
+        if fitted_through >= through:
+            return False
+        detector = load_detector(model_dir)
+        pending = load_pending(model_dir)
+        old_stats = decay_stats(old_stats, (through - fitted_through).days)
+        start = fitted_through + timedelta(days=1)
+
+    # 依時間順序分段讀取，偵測器的狀態和還沒確定的快照從前一段接到下一段
+    new_stats = None
+    chunk_start = start
+    while chunk_start <= through:
+        chunk_end = min(chunk_start + timedelta(days=FETCH_DAYS - 1), through)
+        snapshots = parking_data.fetch_all_snapshots(client, chunk_start, chunk_end)
+        if not snapshots.empty:
+            hourly, pending = compute_hourly(snapshots, detector, pending)
+            if not hourly.empty:
+                new_stats = merge_stats(new_stats, compute_cell_stats(hourly, through))
+        chunk_start = chunk_end + timedelta(days=1)
+
+    if new_stats is None and old_stats is None:
+        return False
+
+    stats = old_stats if new_stats is None else merge_stats(old_stats, new_stats)
+    save_model(stats, fit_params(stats), detector, pending, through, model_dir)
+    return True
+
+
+# ===== 預測 =====
+# 從 start 開始預測 hours 小時，回傳 time、available（預測值）、lower、upper（80% 區間）
+# 區間會限制在 0 ~ total_cars 之間；沒有歷史資料的格子會是空值
+def predict(params, parking_lot_id, start, hours, total_cars):
+    times = pd.Series(pd.date_range(pd.Timestamp(start).ceil('h'), periods=hours, freq='h'))
+    grid = pd.DataFrame({
+        'time': times,
+        'parking_lot_id': parking_lot_id,
+        'day_of_week': _day_of_week(times),
+        'hour': times.dt.hour,
+    })
+    lot_params = params[params['parking_lot_id'] == parking_lot_id]
+    grid = grid.merge(lot_params, on=CELL_KEYS, how='left')
+
+    t = (grid['time'] - ORIGIN) / pd.Timedelta(days=1)
+    mean = grid['level'] + grid['slope'] * t
+    spread = INTERVAL_Z * grid['sigma']
+    return pd.DataFrame({
+        'time': grid['time'],
+        'available': mean.clip(0, total_cars),
+        'lower': (mean - spread).clip(0, total_cars),
+        'upper': (mean + spread).clip(0, total_cars),
+    })
+
+
+# ===== 命令列執行（排程每天跑一次）=====
+# 範例：python forecast.py
+def main():
+    parser = argparse.ArgumentParser(description="增量更新所有停車場的剩餘車位預測模型")
+    parser.add_argument("--model-dir", default=MODEL_DIR, help="模型檔案存放的資料夾")
+    args = parser.parse_args()
+
+    client = parking_data.create_client()
+    if refresh_model(client, args.model_dir):
+        print(f"模型已更新到 {params_version(args.model_dir)}")
+    else:
+        print("沒有新的資料，模型維持不變")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+from datetime import timedelta
+from zoneinfo import ZoneInfo
+
+from google.cloud import bigquery
+from google.oauth2 import service_account
+
+# ===== BigQuery 資料表 =====
+PROJECT_DATASET = "parking-history-taipei.taipei_parking"
+PARKING_LOTS_TABLE = f"{PROJECT_DATASET}.parking_lots"
+REALTIME_SPOTS_TABLE = f"{PROJECT_DATASET}.realtime_spots"
+
+# BigQuery 儲存 UTC 時間，台灣是 UTC+8
+TAIPEI_TZ = ZoneInfo("Asia/Taipei")
+
+# 快照可能晚幾分鐘才寫入，過了午夜 1 小時後才把前一天視為不會再變
+SETTLE_DELAY = timedelta(hours=1)
+
+
+# ===== 建立 BigQuery 連線 =====
+# 儀表板傳入 st.secrets 的服務帳戶；背景排程（沒有 Streamlit）時不傳，改用預設憑證
+def create_client(service_account_info=None):
+    if service_account_info is None:
+        return bigquery.Client()
+    credentials = service_account.Credentials.from_service_account_info(service_account_info)
+    return bigquery.Client(credentials=credentials)
+
+
+# ===== 停車場清單 =====
+def fetch_parking_lots(client):
+    query = f"""
+    SELECT parking_lot_id, name, area, total_cars, total_motor
+    FROM `{PARKING_LOTS_TABLE}`
+    WHERE total_cars > 0
+    ORDER BY name
+    """
+    return client.query(query).to_dataframe()
+
+
+# ===== 單一停車場的停車資料 =====
+def _parking_data_query(parking_lot_id, start_date, end_date, total_cars):
+    return f"""
+    SELECT
+        DATETIME(record_time, 'Asia/Taipei') AS taipei_time,
+        available_cars,
+        {total_cars} AS total_cars,
+        {total_cars} - available_cars AS used_cars,
+        ROUND(({total_cars} - available_cars) / {total_cars} * 100, 1) AS usage_rate,
+        EXTRACT(HOUR FROM DATETIME(record_time, 'Asia/Taipei')) AS hour,
+        EXTRACT(DAYOFWEEK FROM DATETIME(record_time, 'Asia/Taipei')) AS day_of_week,
+        FORMAT_DATETIME('%Y-%m-%d', DATETIME(record_time, 'Asia/Taipei')) AS date_str
+    FROM `{REALTIME_SPOTS_TABLE}`
+    WHERE parking_lot_id = '{parking_lot_id}'
+        AND available_cars >= 0
+        AND DATE(record_time, 'Asia/Taipei') BETWEEN '{start_date}' AND '{end_date}'
+    ORDER BY record_time
+    """
+
+
+def fetch_parking_data(client, parking_lot_id, start_date, end_date, total_cars):
+    query = _parking_data_query(parking_lot_id, start_date, end_date, total_cars)
+    return client.query(query).to_dataframe()
+
+
+# 試算查詢會掃描多少資料（dry run 不會真的執行，也不計費），回傳 bytes
+def estimate_parking_data_bytes(client, parking_lot_id, start_date, end_date, total_cars):
+    query = _parking_data_query(parking_lot_id, start_date, end_date, total_cars)
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    return client.query(query, job_config=job_config).total_bytes_processed
+
+
+# ===== 多個停車場一次查詢 =====
+# 欄位和 fetch_parking_data 相同，多一個 parking_lot_id；一次查詢取代 N 次來回
+def fetch_parking_data_batch(client, parking_lot_ids, start_date, end_date):
+    query = f"""
+    SELECT
+        s.parking_lot_id,
+        DATETIME(s.record_time, 'Asia/Taipei') AS taipei_time,
+        s.available_cars,
+        l.total_cars,
+        l.total_cars - s.available_cars AS used_cars,
+        ROUND((l.total_cars - s.available_cars) / l.total_cars * 100, 1) AS usage_rate,
+        EXTRACT(HOUR FROM DATETIME(s.record_time, 'Asia/Taipei')) AS hour,
+        EXTRACT(DAYOFWEEK FROM DATETIME(s.record_time, 'Asia/Taipei')) AS day_of_week,
+        FORMAT_DATETIME('%Y-%m-%d', DATETIME(s.record_time, 'Asia/Taipei')) AS date_str
+    FROM `{REALTIME_SPOTS_TABLE}` AS s
+    JOIN `{PARKING_LOTS_TABLE}` AS l USING (parking_lot_id)
+    WHERE s.parking_lot_id IN UNNEST(@parking_lot_ids)
+        AND l.total_cars > 0
+        AND s.available_cars >= 0
+        AND DATE(s.record_time, 'Asia/Taipei') BETWEEN @start_date AND @end_date
+    ORDER BY s.parking_lot_id, s.record_time
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("parking_lot_ids", "STRING", list(parking_lot_ids)),
+        bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+        bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+    ])
+    return client.query(query, job_config=job_config).to_dataframe()
+
+
+# ===== 所有停車場的原始快照（預測模型用）=====
+# 不在 BigQuery 先彙總：要先排除感測器異常的資料，再算每小時平均
+def fetch_all_snapshots(client, start_date, end_date):
+    query = f"""
+    SELECT
+        s.parking_lot_id,
+        DATETIME(s.record_time, 'Asia/Taipei') AS taipei_time,
+        s.available_cars,
+        l.total_cars
+    FROM `{REALTIME_SPOTS_TABLE}` AS s
+    JOIN `{PARKING_LOTS_TABLE}` AS l USING (parking_lot_id)
+    WHERE l.total_cars > 0
+        AND s.available_cars >= 0
+        AND DATE(s.record_time, 'Asia/Taipei') BETWEEN @start_date AND @end_date
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+        bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+    ])
+    return client.query(query, job_config=job_config).to_dataframe()
+
+
+# ===== 資料表最後更新時間 =====
+# 讀的是資料表的 metadata，不掃描資料、不計費，可以頻繁呼叫
+def fetch_table_modified(client, table_id):
+    return client.get_table(table_id).modified
+
+
+# 這一天之前的資料都已經寫完，不會再變（modified：即時資料表的最後更新時間）
+def settled_day(modified):
+    return (modified.astimezone(TAIPEI_TZ) - SETTLE_DELAY).date()
+
+
+# ===== 所有停車場的新快照（即時異常監控用）=====
+# since 是上次處理到的 record_time（UTC）；第一次（None）讀最近 24 小時，讓偵測器先累積狀態
+def fetch_snapshots_since(client, since):
+    query = f"""
+    SELECT
+        s.parking_lot_id,
+        s.record_time,
+        DATETIME(s.record_time, 'Asia/Taipei') AS taipei_time,
+        s.available_cars,
+        l.total_cars
+    FROM `{REALTIME_SPOTS_TABLE}` AS s
+    JOIN `{PARKING_LOTS_TABLE}` AS l USING (parking_lot_id)
+    WHERE l.total_cars > 0
+        AND s.available_cars >= 0
+        AND s.record_time > COALESCE(@since, TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR))
+    ORDER BY s.parking_lot_id, s.record_time
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("since", "TIMESTAMP", since),
+    ])
+    return client.query(query, job_config=job_config).to_dataframe()
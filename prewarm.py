@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import parking_data
+
+# ===== 快取預熱設定 =====
+# 每天早上上班前，把最常被查看的「停車場 × 期間 × 粒度」先查好放進快取，
+# 第一位使用者打開儀表板時就不用等 BigQuery
+REQUEST_LOG_PATH = os.environ.get("PREWARM_LOG_PATH", "prewarm_requests.json")
+PREWARM_TIME = "07:30"            # 台北時間
+PREWARM_TOP_K = 20                # 最多預熱幾組
+PREWARM_CONCURRENCY = 3           # 同時執行幾個查詢
+PREWARM_BYTE_BUDGET = 5 * 1024**3  # 每次預熱最多掃描 5 GB
+RECENT_DAYS = 14                  # 只看最近 14 天內有人查過的組合
+CACHE_DIR = os.environ.get("PREWARM_CACHE_DIR", "prewarm_cache")
+
+
+# ===== 查詢紀錄 =====
+# 結束日期是今天的期間存成「往前幾天」（例如最近 7 天），隔天重播時才會對應到新的日期
+# 其他期間（例如上個月）存實際日期，隔天重播時還是同一段
+# 多個使用者同時使用，所以寫入時要加鎖
+class RequestLog:
+    def __init__(self, path=REQUEST_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for entry in json.load(f):
+                    self._entries[self._key(entry)] = entry
+
+    @staticmethod
+    def _key(entry):
+        return (entry['parking_lot_id'], entry.get('start_offset'), entry.get('start_date'), entry.get('end_date'), entry['gran'])
+
+    def record(self, parking_lot_id, start_date, end_date, gran, today):
+        if end_date == today:
+            entry = {'parking_lot_id': parking_lot_id, 'start_offset': (today - start_date).days, 'gran': gran}
+        else:
+            entry = {'parking_lot_id': parking_lot_id, 'start_date': start_date.isoformat(), 'end_date': end_date.isoformat(), 'gran': gran}
+        with self._lock:
+            saved = self._entries.setdefault(self._key(entry), {**entry, 'count': 0})
+            saved['count'] += 1
+            saved['last_seen'] = today.isoformat()
+            self._save()
+
+    def _save(self):
+        # 先寫暫存檔再換名，避免寫到一半當機留下壞掉的檔案
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self._entries.values()), f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    # 最近常被查看的前 k 組，依查看次數排序
+    def top(self, k, today):
+        cutoff = (today - timedelta(days=RECENT_DAYS)).isoformat()
+        with self._lock:
+            recent = [dict(e) for e in self._entries.values() if e['last_seen'] >= cutoff]
+        recent.sort(key=lambda e: e['count'], reverse=True)
+        return recent[:k]
+
+
+# 把紀錄的期間換成實際日期（最近 N 天的期間對應到今天）
+def resolve_dates(entry, today):
+    if 'start_offset' in entry:
+        return today - timedelta(days=entry['start_offset']), today
+    return date.fromisoformat(entry['start_date']), date.fromisoformat(entry['end_date'])
+
+
+# 一組查詢中已經不會變的歷史部分（settled_day 之前）；整段都還在寫入時回傳 None
+def history_range(entry, today, settled_day):
+    start, end = resolve_dates(entry, today)
+    if start >= settled_day:
+        return None
+    return start, min(end, settled_day - timedelta(days=1))
+
+
+# ===== 歷史資料檔案 =====
+# 排程（python prewarm.py）是另一個程序，碰不到儀表板記憶體裡的快取，
+# 所以把不會再變的歷史資料存成檔案，儀表板查詢同一段資料時直接讀檔
+# 檔名：停車場代碼_總車位_開始日期_結束日期.parquet
+HISTORY_FILE_PATTERN = re.compile(r".+_\d+_\d{4}-\d{2}-\d{2}_\d{4}-\d{2}-\d{2}\.parquet")
+
+
+def history_path(parking_lot_id, start_date, end_date, total_cars, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"{parking_lot_id}_{total_cars}_{start_date}_{end_date}.parquet")
+
+
+def load_history(parking_lot_id, start_date, end_date, total_cars, cache_dir=CACHE_DIR):
+    path = history_path(parking_lot_id, start_date, end_date, total_cars, cache_dir)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def save_history(df, parking_lot_id, start_date, end_date, total_cars, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = history_path(parking_lot_id, start_date, end_date, total_cars, cache_dir)
+    # 先寫暫存檔再換名，儀表板不會讀到寫一半的檔案
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+# ===== 執行預熱 =====
+# estimate_bytes(entry) 回傳查詢會掃描的 bytes（BigQuery dry run，不計費）
+# warm(entry) 實際查詢並放進快取
+# 依排名順序挑選，超過預算的組合就跳過；單一組合出錯不影響其他組合
+def run_prewarm(entries, estimate_bytes, warm, byte_budget=PREWARM_BYTE_BUDGET, max_workers=PREWARM_CONCURRENCY):
+    def safe_estimate(entry):
+        try:
+            return estimate_bytes(entry)
+        except Exception as e:
+            print(f"快取預熱試算失敗，略過 {entry}：{e!r}")
+            return None
+
+    def safe_warm(entry):
+        try:
+            warm(entry)
+            return True
+        except Exception as e:
+            print(f"快取預熱失敗 {entry}：{e!r}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        estimates = list(pool.map(safe_estimate, entries))
+
+        selected = []
+        skipped = []
+        used_bytes = 0
+        for entry, estimate in zip(entries, estimates):
+            if estimate is None or used_bytes + estimate > byte_budget:
+                skipped.append(entry)
+                continue
+            used_bytes += estimate
+            selected.append(entry)
+
+        results = list(pool.map(safe_warm, selected))
+
+    return {
+        'warmed': [e for e, ok in zip(selected, results) if ok],
+        'failed': [e for e, ok in zip(selected, results) if not ok],
+        'skipped': skipped,
+        'bytes': used_bytes,
+    }
+
+
+# 預熱結果摘要（儀表板的背景排程和命令列共用）
+def print_result(result):
+    print(f"快取預熱完成：{len(result['warmed'])} 組，略過 {len(result['skipped'])} 組，失敗 {len(result['failed'])} 組，"
+          f"預估掃描 {result['bytes'] / 1024**3:.2f} GB")
+
+
+# ===== 每天定時執行 =====
+def seconds_until(run_at, now):
+    hour, minute = map(int, run_at.split(":"))
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+# 在背景執行緒每天 run_at（台北時間）呼叫一次 job；job 出錯不會讓排程停掉
+# on_start（可省略）：執行緒一啟動就先執行一次（例如 app 剛部署、還沒有模型時）
+def start_scheduler(job, run_at=PREWARM_TIME, on_start=None):
+    def run(task):
+        try:
+            task()
+        except Exception as e:
+            print(f"背景排程失敗：{e!r}")
+
+    def loop():
+        if on_start is not None:
+            run(on_start)
+        while True:
+            time.sleep(seconds_until(run_at, datetime.now(parking_data.TAIPEI_TZ)))
+            run(job)
+
+    thread = threading.Thread(target=loop, name="cache-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+# ===== 命令列執行（給 cron 排程，不開儀表板）=====
+# 把最常被查看的組合中「已經不會變的歷史資料」查好存成檔案，儀表板之後直接讀檔，不用查 BigQuery
+# 範例：python prewarm.py（要在儀表板的工作目錄執行，或用環境變數指定 PREWARM_LOG_PATH、PREWARM_CACHE_DIR）
+def main():
+    parser = argparse.ArgumentParser(description="預先查好常用的停車場歷史資料（快取預熱）")
+    parser.add_argument("--top", type=int, default=PREWARM_TOP_K, help="最多預熱幾組")
+    parser.add_argument("--budget-gb", type=float, default=PREWARM_BYTE_BUDGET / 1024**3, help="最多掃描幾 GB")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="歷史資料檔案存放的資料夾")
+    args = parser.parse_args()
+
+    client = parking_data.create_client()
+    today = datetime.now(parking_data.TAIPEI_TZ).date()
+    settled_day = parking_data.settled_day(parking_data.fetch_table_modified(client, parking_data.REALTIME_SPOTS_TABLE))
+    total_cars = parking_data.fetch_parking_lots(client).set_index('parking_lot_id')['total_cars']
+
+    # 同一個停車場 × 期間只查一次（不同粒度用的是同一段資料）
+    jobs = {}
+    for entry in RequestLog().top(args.top, today):
+        history = history_range(entry, today, settled_day)
+        if history is None or entry['parking_lot_id'] not in total_cars.index:
+            continue
+        job = (entry['parking_lot_id'], *history, int(total_cars[entry['parking_lot_id']]))
+        jobs[job] = {'parking_lot_id': job[0], 'start_date': job[1], 'end_date': job[2], 'total_cars': job[3]}
+    jobs = list(jobs.values())
+
+    def estimate_bytes(job):
+        if os.path.exists(history_path(**job, cache_dir=args.cache_dir)):
+            return 0
+        return parking_data.estimate_parking_data_bytes(client, **job)
+
+    def warm(job):
+        if os.path.exists(history_path(**job, cache_dir=args.cache_dir)):
+            return
+        save_history(parking_data.fetch_parking_data(client, **job), **job, cache_dir=args.cache_dir)
+
+    result = run_prewarm(jobs, estimate_bytes, warm, byte_budget=args.budget_gb * 1024**3)
+
+    # 清掉這次沒有用到的舊檔案（例如昨天的「最近 7 天」），資料夾大小不會一直增加
+    # 只刪除這個工具產生的歷史資料檔案，資料夾裡的其他檔案不動
+    keep = {history_path(**job, cache_dir=args.cache_dir) for job in jobs}
+    if os.path.isdir(args.cache_dir):
+        for name in os.listdir(args.cache_dir):
+            path = os.path.join(args.cache_dir, name)
+            if HISTORY_FILE_PATTERN.fullmatch(name) and os.path.isfile(path) and path not in keep:
+                os.remove(path)
+
+    print_result(result)
+
+
+if __name__ == "__main__":
+    main()
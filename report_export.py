@@ -0,0 +1,183 @@
+import argparse
+import io
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import pandas as pd
+import plotly.io as pio
+from PIL import Image
+
+import charts
+import parking_data
+
+# ===== 報表匯出設定 =====
+# 投標會議用的報表包：每個停車場一頁，內容是指標卡片、熱力圖、週間 vs 週末曲線
+EXPORT_FORMATS = {"pdf": "PDF", "xlsx": "Excel"}
+EXPORT_MIME_TYPES = {
+    "pdf": "application/pdf",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+FIGURE_WIDTH = 1400
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+# ===== 組出一個停車場要放進報表的圖 =====
+# 直接使用 charts.py 的圖表定義，和儀表板上看到的一樣
+def build_lot_figures(lot, period_text):
+    aggregates = lot['aggregates']
+    title = f"{lot['name']}（{lot['parking_lot_id']}）｜{lot['area']}｜汽車車位 {lot['total_cars']} 格｜{period_text}"
+    return [
+        charts.build_summary_figure(aggregates['summary'], title),
+        charts.build_heatmap_figure(aggregates['heatmap'][charts.HEATMAP_USAGE], charts.HEATMAP_USAGE, lot['total_cars']),
+        charts.build_weekday_weekend_figure(aggregates['weekday_hourly'], aggregates['weekend_hourly']),
+    ]
+
+
+# ===== 在背景程序中把圖轉成 PNG =====
+# 必須放在模組最外層，ProcessPoolExecutor 才能把它送到其他程序執行
+def _render_png(fig_json):
+    fig = pio.from_json(fig_json)
+    return fig.to_image(format="png", width=FIGURE_WIDTH, height=fig.layout.height, scale=1)
+
+
+# 用多個程序同時轉圖（kaleido 每張圖要啟動瀏覽器繪製，逐張轉會很慢）
+def render_figures(figures, max_workers=DEFAULT_WORKERS):
+    payloads = [fig.to_json() for fig in figures]
+    if max_workers <= 1:
+        return [_render_png(p) for p in payloads]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_render_png, payloads))
+
+
+# ===== 組成 PDF：每個停車場一頁，圖片由上往下排 =====
+def assemble_pdf(pages):
+    page_images = []
+    for pngs in pages:
+        images = [Image.open(io.BytesIO(png)).convert("RGB") for png in pngs]
+        page = Image.new("RGB", (max(img.width for img in images), sum(img.height for img in images)), "#0f172a")
+        y = 0
+        for img in images:
+            page.paste(img, (0, y))
+            y += img.height
+        page_images.append(page)
+
+    buffer = io.BytesIO()
+    page_images[0].save(buffer, format="PDF", save_all=True, append_images=page_images[1:], resolution=150)
+    return buffer.getvalue()
+
+
+# ===== 組成 Excel：第一頁是總表，之後每個停車場一個工作表 =====
+def assemble_excel(lots, pages):
+    summary_rows = []
+    for lot in lots:
+        summary = lot['aggregates']['summary']
+        summary_rows.append({
+            '停車場代碼': lot['parking_lot_id'],
+            '停車場名稱': lot['name'],
+            '區域': lot['area'],
+            '汽車總車位': lot['total_cars'],
+            '平均剩餘車位': round(summary['avg_available'], 1),
+            '平均使用率 (%)': round(summary['avg_usage'], 1),
+            '最高剩餘車位': summary['max_available'],
+            '最高剩餘時間': summary['max_time'],
+            '最低剩餘車位': summary['min_available'],
+            '最低剩餘時間': summary['min_time'],
+            '尖峰時段': summary['peak_hours_str'],
+            '週間使用率 (%)': round(summary['weekday_avg'], 1),
+            '週末使用率 (%)': round(summary['weekend_avg'], 1),
+        })
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        pd.DataFrame(summary_rows).to_excel(writer, sheet_name="總表", index=False)
+
+        for lot, pngs in zip(lots, pages):
+            # 工作表名稱用停車場代碼（Excel 限制 31 字且不能有特殊符號）
+            sheet_name = lot['parking_lot_id']
+            heatmap = lot['aggregates']['heatmap'][charts.HEATMAP_USAGE].round(1)
+            heatmap.index = [charts.WEEKDAY_NAMES[d] for d in heatmap.index]
+            heatmap.to_excel(writer, sheet_name=sheet_name, startrow=1)
+
+            worksheet = writer.sheets[sheet_name]
+            worksheet.write(0, 0, f"{lot['name']} 熱力圖（平均使用率 %，星期 × 小時）")
+            row = len(heatmap) + 4
+            for png in pngs:
+                worksheet.insert_image(row, 0, f"{sheet_name}.png", {'image_data': io.BytesIO(png), 'x_scale': 0.6, 'y_scale': 0.6})
+                row += int(Image.open(io.BytesIO(png)).height * 0.6 / 20) + 2
+    return buffer.getvalue()
+
+
+# ===== 匯出報表包 =====
+# lots 是 dict 清單：parking_lot_id、name、area、total_cars、aggregates（charts.compute_aggregates 的結果）
+def export_report_pack(lots, fmt, period_text, max_workers=DEFAULT_WORKERS):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支援的匯出格式：{fmt}")
+    if not lots:
+        raise ValueError("沒有可匯出的停車場資料")
+
+    lot_figures = [build_lot_figures(lot, period_text) for lot in lots]
+
+    # 所有停車場的圖一起丟進程序池，轉完再依停車場切回來
+    pngs = render_figures([fig for figures in lot_figures for fig in figures], max_workers)
+    pages = []
+    offset = 0
+    for figures in lot_figures:
+        pages.append(pngs[offset:offset + len(figures)])
+        offset += len(figures)
+
+    if fmt == "pdf":
+        return assemble_pdf(pages)
+    return assemble_excel(lots, pages)
+
+
+# ===== 命令列執行（不開儀表板，直接產生報表）=====
+# 範例：python report_export.py --lots TPE0410,TPE0411 --start 2025-12-01 --end 2025-12-31 --format pdf
+def main():
+    parser = argparse.ArgumentParser(description="批次匯出停車場報表（PDF / Excel）")
+    parser.add_argument("--lots", required=True, help="停車場代碼，用逗號分隔")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="開始日期 YYYY-MM-DD")
+    parser.add_argument("--end", required=True, type=date.fromisoformat, help="結束日期 YYYY-MM-DD")
+    parser.add_argument("--format", default="pdf", choices=list(EXPORT_FORMATS), help="輸出格式")
+    parser.add_argument("--output", help="輸出檔名（預設：report_開始_結束.格式）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="同時轉圖的程序數")
+    args = parser.parse_args()
+
+    lot_ids = [lot_id.strip() for lot_id in args.lots.split(",") if lot_id.strip()]
+    client = parking_data.create_client()
+
+    # 停車場資料一次查詢，不用每個停車場各查一次
+    parking_lots = parking_data.fetch_parking_lots(client).set_index('parking_lot_id')
+    data = parking_data.fetch_parking_data_batch(client, lot_ids, args.start, args.end)
+
+    lots = []
+    for lot_id in lot_ids:
+        lot_df = data[data['parking_lot_id'] == lot_id].reset_index(drop=True)
+        aggregates = charts.compute_aggregates(lot_df, charts.GRANULARITY_MAP["1 小時"])
+        if lot_id not in parking_lots.index or aggregates is None:
+            print(f"略過 {lot_id}：所選日期範圍內沒有資料")
+            continue
+        info = parking_lots.loc[lot_id]
+        lots.append({
+            'parking_lot_id': lot_id,
+            'name': info['name'],
+            'area': info['area'],
+            'total_cars': int(info['total_cars']),
+            'aggregates': aggregates,
+        })
+
+    if not lots:
+        print("所有停車場在所選日期範圍內都沒有資料，沒有產生報表")
+        sys.exit(1)
+
+    period_text = f"資料期間：{args.start} - {args.end}"
+    content = export_report_pack(lots, args.format, period_text, args.workers)
+    output = args.output or f"report_{args.start}_{args.end}.{args.format}"
+    with open(output, "wb") as f:
+        f.write(content)
+    print(f"已匯出 {len(lots)} 個停車場到 {output}")
+
+
+if __name__ == "__main__":
+    main()
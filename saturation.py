@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+# ===== 滿位事件設定 =====
+# 「滿位事件」：剩餘車位連續低於門檻的一段時間
+# 一次處理全部停車場（排序後用向量運算找出每一段），不用逐筆跑迴圈
+FULL_RATIO = 0.02                          # 剩餘車位 ≤ 總車位 2% 視為滿位（小停車場至少要 0 格）
+SNAPSHOT_INTERVAL = pd.Timedelta(minutes=5)
+MAX_GAP = pd.Timedelta(minutes=15)         # 兩筆資料間隔超過 15 分鐘視為資料中斷，事件從這裡切開
+
+DURATION_BINS = [0, 15, 30, 60, 120, 240, np.inf]   # 分鐘
+DURATION_LABELS = ['15 分鐘內', '15-30 分鐘', '30-60 分鐘', '1-2 小時', '2-4 小時', '4 小時以上']
+
+
+# ===== 找出所有滿位事件 =====
+# df 欄位：taipei_time、available_cars、total_cars，多停車場時要有 parking_lot_id
+# 回傳每個事件一列：parking_lot_id、start、end、snapshots、duration_min、start_hour
+def find_episodes(df, full_ratio=FULL_RATIO):
+    if 'parking_lot_id' in df.columns:
+        lot_ids = df['parking_lot_id'].to_numpy()
+    else:
+        lot_ids = np.zeros(len(df), dtype=int)
+    frame = pd.DataFrame({
+        'parking_lot_id': lot_ids,
+        'time': pd.to_datetime(df['taipei_time']).to_numpy(),
+        'available_cars': df['available_cars'].to_numpy(),
+        'total_cars': df['total_cars'].to_numpy(),
+    }).sort_values(['parking_lot_id', 'time'], kind='stable', ignore_index=True)
+
+    threshold = np.floor(frame['total_cars'] * full_ratio)
+    is_full = (frame['available_cars'] <= threshold).to_numpy()
+
+    # 新的一段從這裡開始：換停車場、資料中斷、或前一筆不是滿位
+    lot_changed = frame['parking_lot_id'].ne(frame['parking_lot_id'].shift()).to_numpy()
+    gap = (frame['time'].diff() > MAX_GAP).to_numpy()
+    prev_full = np.concatenate([[False], is_full[:-1]])
+    run_start = is_full & (lot_changed | gap | ~prev_full)
+    run_id = np.cumsum(run_start)
+
+    full = frame[is_full].assign(run_id=run_id[is_full])
+    episodes = full.groupby('run_id').agg(
+        parking_lot_id=('parking_lot_id', 'first'),
+        start=('time', 'min'),
+        end=('time', 'max'),
+        snapshots=('time', 'size'),
+    ).reset_index(drop=True)
+
+    # 每筆快照代表往後 5 分鐘，所以只有一筆滿位的事件也算 5 分鐘
+    episodes['duration_min'] = (episodes['end'] - episodes['start'] + SNAPSHOT_INTERVAL) / pd.Timedelta(minutes=1)
+    episodes['start_hour'] = episodes['start'].dt.hour
+    return episodes
+
+
+# ===== 接起兩段相鄰資料的事件 =====
+# before 的最後一個事件持續到那段資料的最後一筆（before_last_time）、after 的第一個事件從第一筆（after_first_time）開始，
+# 而且中間沒有中斷時，兩個事件其實是同一次滿位，合併成一個
+def concat_episodes(before, before_last_time, after, after_first_time):
+    if before.empty:
+        return after
+    if after.empty:
+        return before
+
+    last = before.iloc[-1]
+    first = after.iloc[0]
+    if last['end'] != before_last_time or first['start'] != after_first_time or after_first_time - before_last_time > MAX_GAP:
+        return pd.concat([before, after], ignore_index=True)
+
+    joined = before.copy()
+    joined.loc[joined.index[-1], 'end'] = first['end']
+    joined.loc[joined.index[-1], 'snapshots'] += first['snapshots']
+    joined['duration_min'] = (joined['end'] - joined['start'] + SNAPSHOT_INTERVAL) / pd.Timedelta(minutes=1)
+    return pd.concat([joined, after.iloc[1:]], ignore_index=True)
+
+
+# ===== 每個停車場的統計 =====
+# lot_ids（可省略）：要列出的停車場，沒有滿位事件的也會顯示 0
+def summarize_episodes(episodes, lot_ids=None):
+    grouped = episodes.groupby('parking_lot_id')
+    summary = pd.DataFrame({
+        'episode_count': grouped.size(),
+        'full_hours': grouped['duration_min'].sum() / 60,
+        'median_min': grouped['duration_min'].median(),
+        'longest_min': grouped['duration_min'].max(),
+        'top_start_hour': grouped['start_hour'].agg(lambda hours: hours.mode().iloc[0]),
+    })
+    if lot_ids is not None:
+        summary = summary.reindex(lot_ids)
+        summary[['episode_count', 'full_hours']] = summary[['episode_count', 'full_hours']].fillna(0)
+    summary['episode_count'] = summary['episode_count'].astype(int)
+    summary.index.name = 'parking_lot_id'
+    return summary.reset_index()
+
+
+# ===== 持續時間分布（每個停車場 × 時間區間的事件數）=====
+def duration_histogram(episodes):
+    bins = pd.cut(episodes['duration_min'], DURATION_BINS, labels=DURATION_LABELS, right=True)
+    return pd.crosstab(episodes['parking_lot_id'], bins).reindex(columns=DURATION_LABELS, fill_value=0)
+
+
+# ===== 開始時段分布（每個停車場 × 幾點開始滿位的事件數）=====
+def start_hour_distribution(episodes):
+    return pd.crosstab(episodes['parking_lot_id'], episodes['start_hour']).reindex(columns=range(24), fill_value=0)
+
+
+# ===== 分鐘數轉成「X 小時 Y 分」=====
+def format_minutes(minutes):
+    hours, mins = divmod(int(round(minutes)), 60)
+    if hours == 0:
+        return f"{mins} 分"
+    return f"{hours} 小時 {mins} 分" if mins else f"{hours} 小時"